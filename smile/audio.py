@@ -14,7 +14,6 @@ from ref import Ref, val
 # get the last instance of the experiment class
 from experiment import Experiment, now, event_time
 
-from pyglet import clock
 import pyglet
 
 # add in system site-packages if necessary
@@ -0,0 +1,188 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy as np
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+from log import flatten_rows
+
+# name of the group for records that are not from a state (e.g., Log)
+DEFAULT_GROUP = 'log'
+
+# characters that can't be in a group's directory name
+_unsafe_chars = re.compile(r'[^\w.-]')
+
+class ColumnStore(object):
+    """
+    Accumulate log records in memory as columns, grouped by state class.
+
+    A ColumnStore can be added as a sink to a LogWriter so the rows are
+    appended from the writer thread as they are logged. At the end of
+    the session `save` writes each column as a .npy file, which can be
+    memory mapped with `load_columns` instead of parsing the yaml logs.
+
+    Example
+    -------
+    store = ColumnStore()
+    exp.state_log_writer.sinks.append(store)
+    ...
+    store.save('data/test000/columns')
+    cols = load_columns('data/test000/columns')
+    rts = cols['KeyPress']['rt']
+    """
+    def __init__(self):
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def append_rows(self, records):
+        """
+        Append a list of (fields, row) records. Nested values (e.g.,
+        event times) are unwrapped into their own columns. The records
+        are grouped by their state, with any characters that can't be
+        in a directory name replaced, and those without one go in the
+        DEFAULT_GROUP.
+        """
+        # split them up by fields and state
+        batches = OrderedDict()
+        for fields, row in records:
+            if 'state' in fields:
+                group = _group_name(row[fields.index('state')])
+            else:
+                group = DEFAULT_GROUP
+            key = (group, fields)
+            if not key in batches:
+                batches[key] = []
+            batches[key].append(row)
+
+        # flatten each batch and add it to the columns
+        with self._lock:
+            for (group, fields), rows in batches.iteritems():
+                self._extend(group, *flatten_rows(fields, rows))
+
+    def append(self, fields, row):
+        """
+        Append one record, given as a tuple of field names and a
+        matching tuple of values.
+        """
+        self.append_rows([(fields, row)])
+
+    def _extend(self, group, names, new_columns):
+        if not group in self._groups:
+            self._groups[group] = {'nrows':0, 'columns':OrderedDict()}
+        nrows = self._groups[group]['nrows']
+        columns = self._groups[group]['columns']
+        nnew = len(new_columns[0]) if new_columns else 0
+
+        # add the values, padding any new columns
+        for k, col in zip(names, new_columns):
+            if not k in columns:
+                columns[k] = [None]*nrows
+            columns[k].extend(col)
+
+        # pad the columns missing from these records
+        nrows += nnew
+        for k in columns:
+            if len(columns[k]) < nrows:
+                columns[k].extend([None]*nnew)
+        self._groups[group]['nrows'] = nrows
+
+    def groups(self):
+        """
+        Names of the groups (state classes) that have been logged.
+        """
+        return self._groups.keys()
+
+    def to_arrays(self):
+        """
+        Convert the columns to numpy arrays, returned as a dict of
+        dicts keyed by group and then column name.
+        """
+        if not have_numpy:
+            raise ImportError("You must install numpy to export columns.")
+        with self._lock:
+            return {group: OrderedDict([(k, _to_array(v))
+                                        for k, v in g['columns'].iteritems()])
+                    for group, g in self._groups.iteritems()}
+
+    def save(self, path):
+        """
+        Save the columns as path/<group>/<column>.npy files.
+        """
+        for group, columns in self.to_arrays().iteritems():
+            group_dir = os.path.join(path, group)
+            if not os.path.exists(group_dir):
+                os.makedirs(group_dir)
+            for k, arr in columns.iteritems():
+                np.save(os.path.join(group_dir, k+'.npy'), arr)
+
+
+def _group_name(state):
+    # the state of a record as the name of a directory in the save
+    # path (it can be anything that was logged)
+    if state is None:
+        return DEFAULT_GROUP
+    if not isinstance(state, basestring):
+        state = str(state)
+    name = str(_unsafe_chars.sub('_', state).lstrip('.'))
+    if not name:
+        return DEFAULT_GROUP
+    return name
+
+def _to_array(values):
+    # pick the most specific dtype we can, so the array can be mapped
+    all_types = set(map(type, values))
+    types = all_types - set([type(None)])
+    if types and types <= set([int, long, float, bool]):
+        if types == all_types:
+            # no missing values
+            return np.array(values)
+        # use nan for the missing values
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=float)
+    if types and types <= set([str, unicode]):
+        return np.array(['' if v is None else v for v in values])
+    # leave it as objects (these can't be memory mapped)
+    arr = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        arr[i] = v
+    return arr
+
+def load_columns(path, mmap_mode='r'):
+    """
+    Load columns saved by a ColumnStore as a dict of dicts keyed by
+    group and then column name. Numeric and string columns are memory
+    mapped with the specified mmap_mode.
+    """
+    if not have_numpy:
+        raise ImportError("You must install numpy to load columns.")
+    columns = {}
+    for group in sorted(os.listdir(path)):
+        group_dir = os.path.join(path, group)
+        if not os.path.isdir(group_dir):
+            continue
+        columns[group] = {}
+        for f in sorted(os.listdir(group_dir)):
+            name, ext = os.path.splitext(f)
+            if ext != '.npy':
+                continue
+            filename = os.path.join(group_dir, f)
+            try:
+                columns[group][name] = np.load(filename, mmap_mode=mmap_mode)
+            except ValueError:
+                # object arrays must be unpickled
+                columns[group][name] = np.load(filename, allow_pickle=True)
+    return columns
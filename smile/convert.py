@@ -0,0 +1,148 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+"""
+Convert the logs of every subject in a data directory to csv.
+
+Usage:
+
+    python -m smile.convert [data_dir] [-j PROCESSES] [-f] [-s]
+
+Logs are found by walking the data directory (laid out as
+data/<subject>/state.yaml, exp.yaml, etc.) and converted in parallel
+with a process pool. Logs whose csv is newer than the log itself are
+skipped unless forced. Records damaged by a crash are skipped with a
+warning unless strict.
+"""
+
+import os
+import sys
+import time
+import argparse
+from multiprocessing import Pool
+
+from log import log2csv, BINARY_EXT
+
+LOG_EXTS = ('.yaml', BINARY_EXT)
+
+def find_logs(data_dir='data', force=False):
+    """
+    Walk the data directory and return a list of (log_file, csv_file)
+    pairs that need converting.
+    """
+    to_convert = []
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for f in sorted(files):
+            base, ext = os.path.splitext(f)
+            if not ext in LOG_EXTS:
+                continue
+            log_file = os.path.join(root, f)
+            csv_file = os.path.join(root, base+'.csv')
+            if not force and os.path.exists(csv_file) and \
+               os.path.getmtime(csv_file) >= os.path.getmtime(log_file):
+                # already up to date
+                continue
+            to_convert.append((log_file, csv_file))
+    return to_convert
+
+def _convert(files):
+    # worker for the pool, must be picklable
+    log_file, csv_file, strict = files
+    start = time.time()
+    try:
+        nrows = log2csv(log_file, csv_file, strict=strict)
+    except Exception, e:
+        # don't leave a partial csv that looks up to date
+        if os.path.exists(csv_file):
+            os.remove(csv_file)
+        return log_file, 0, 0, time.time()-start, ' '.join(str(e).split())
+    return log_file, nrows or 0, os.path.getsize(log_file), \
+        time.time()-start, None
+
+def convert_tree(data_dir='data', processes=None, force=False, strict=False,
+                 verbose=True):
+    """
+    Convert all the logs in a data directory to csv.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory to search for yaml and binary logs.
+    processes : int
+        Number of worker processes, defaults to the number of cores.
+    force : bool
+        Convert even if the csv files are up to date.
+    strict : bool
+        Fail on damaged records instead of skipping them.
+    verbose : bool
+        Print progress and throughput.
+
+    Returns a list of (log_file, nrows, nbytes, seconds, error) tuples,
+    one for each converted log.
+    """
+    to_convert = [(log_file, csv_file, strict) 
+                  for log_file, csv_file in find_logs(data_dir, force=force)]
+    if len(to_convert) == 0:
+        if verbose:
+            print "All logs in %s are up to date." % data_dir
+        return []
+
+    start = time.time()
+    results = []
+    pool = Pool(processes)
+    try:
+        for res in pool.imap_unordered(_convert, to_convert):
+            results.append(res)
+            if verbose:
+                if res[4] is None:
+                    print "%s: %d rows in %.2f s" % (res[0], res[1], res[3])
+                else:
+                    print "%s: FAILED (%s)" % (res[0], res[4])
+    finally:
+        pool.close()
+        pool.join()
+    duration = time.time()-start
+
+    if verbose:
+        nrows = sum([r[1] for r in results])
+        nbytes = sum([r[2] for r in results])
+        nfailed = len([r for r in results if not r[4] is None])
+        print "Converted %d logs (%d failed) in %.2f s:" % \
+            (len(results), nfailed, duration)
+        print "  %.1f rows/s, %.2f MB/s" % (nrows/duration,
+                                             nbytes/duration/1e6)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert SMILE logs to csv.')
+    parser.add_argument("data_dir", nargs='?', 
+                        help="data directory to search for logs", 
+                        default='data')
+    parser.add_argument("-j", "--processes", 
+                        help="number of worker processes", 
+                        type=int,
+                        default=None)
+    parser.add_argument("-f", "--force", 
+                        help="convert even if the csv is up to date", 
+                        action='store_true')
+    parser.add_argument("-s", "--strict", 
+                        help="fail on damaged records instead of skipping them", 
+                        action='store_true')
+    args = parser.parse_args(argv)
+
+    results = convert_tree(args.data_dir, processes=args.processes,
+                           force=args.force, strict=args.strict)
+    if [r for r in results if not r[4] is None]:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
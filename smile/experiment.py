@@ -11,22 +11,33 @@
 #from __future__ import with_statement
 import sys
 import os
+import random
 import weakref
+import atexit
 import argparse
+import cPickle
 
-# pyglet imports
+# pyglet imports (gl is only needed for a real window, see
+# _setup_window)
+from utils import setup_pyglet
+setup_pyglet()
 import pyglet
-from pyglet.gl import *
 from pyglet import clock
 from pyglet.window import key,Window
 
 # local imports
-from state import Serial, State, RunOnEnter
-from ref import val, Ref
-from log import dump, yaml2csv
+from state import Serial, State, RunOnEnter, now
+import scheduler
+from scheduler import VirtualClock
+from ref import val, Ref, pure, invalidate, enable_cache, RefSharer, \
+    snapshot
+from log import log2csv, LogWriter, BinaryLogWriter, BINARY_EXT, INDEX_EXT
+from columns import ColumnStore, have_numpy
+from refprof import RefProfiler
+from sim import SimWindow, RandomResponder, ScriptedResponder
+from pool import ShownPool
+from utils import get_class_name
 
-# set up the basic timer
-now = clock._default.time
 def event_time(time, time_error=0.0):
     return {'time':time, 'error':time_error}
     
@@ -50,6 +61,9 @@ class ExpWindow(Window):
         # eventually we'll need multiple groups
         self.batch = pyglet.graphics.Batch()
 
+        # recycle the shown stimuli
+        self.pool = ShownPool(self.batch)
+
         # say we've got nothing to plot
         self.need_flip = False
         self.need_draw = False
@@ -61,6 +75,7 @@ class ExpWindow(Window):
             self.need_flip = True
 
     def set_clear_color(self,color=(0,0,0,1)):
+        from pyglet.gl import glClearColor
         glClearColor(*color)
                 
     def on_mouse_motion(self, x, y, dx, dy):
@@ -119,6 +134,15 @@ class Experiment(Serial):
     screen_id : int
         What screen/monitor to send the window to in multi-monitor 
         layouts.
+    ref_cache : bool
+        Cache the values of Refs within each tick of the event loop,
+        so a Ref used by many states is only evaluated once (see
+        ref.enable_cache).
+    responder : responder
+        Where the key and mouse presses come from when simulating
+        (see sim.RandomResponder and sim.ScriptedResponder). Defaults
+        to the responses file given on the command line, if any, and
+        otherwise random responses.
     
     Example
     -------
@@ -137,7 +161,8 @@ class Experiment(Serial):
     docstring for addtional logged parameters.              
     """
     def __init__(self, fullscreen=False, resolution=(800,600), name="Smile",
-                 pyglet_vsync=True, background_color=(0,0,0,1), screen_ind=0):
+                 pyglet_vsync=True, background_color=(0,0,0,1), screen_ind=0,
+                 ref_cache=False, responder=None):
 
         # first process the args
         self._process_args()
@@ -146,16 +171,17 @@ class Experiment(Serial):
         super(Experiment, self).__init__(parent=None, duration=-1)
 
         # set up the window
-        screens = pyglet.window.get_platform().get_default_display().get_screens()
         if screen_ind != self.screen_ind:
             # command line overrides
             screen_ind = self.screen_ind
-        self.screen = screens[screen_ind]
+        self.screen = self._get_screen()
         self.pyglet_vsync = pyglet_vsync
         self.fullscreen = fullscreen or self.fullscreen
         self.resolution = resolution
         self.name = name
         self.window = None   # will create when run
+        self.ref_cache = ref_cache
+        self.responder = responder
 
         # set the clear color
         self._background_color = background_color
@@ -183,11 +209,8 @@ class Experiment(Serial):
         # place to save experimental variables
         self._vars = {}
 
-        # add log locs (state.yaml, experiment.yaml)
-        self.state_log = os.path.join(self.subj_dir,'state.yaml')
-        self.state_log_stream = open(self.state_log,'a')
-        self.exp_log = os.path.join(self.subj_dir,'exp.yaml')
-        self.exp_log_stream = open(self.exp_log,'a')
+        # open the logs
+        self._open_logs()
 
         # # grab the nice
         # import psutil
@@ -201,6 +224,54 @@ class Experiment(Serial):
         # self._current_proc.set_nice(new_nice)
         # print "New nice: %d" % self._current_proc.get_nice()
 
+    def _open_logs(self):
+        # add log locs (state.yaml, experiment.yaml or the binary
+        # equivalents), opened in binary mode so the offsets in the
+        # index are exact
+        if self.binary:
+            ext, writer = BINARY_EXT, BinaryLogWriter
+        else:
+            ext, writer = '.yaml', LogWriter
+        self.state_log = os.path.join(self.subj_dir,'state'+ext)
+        self.state_log_stream = open(self.state_log,'ab')
+        self.exp_log = os.path.join(self.subj_dir,'exp'+ext)
+        self.exp_log_stream = open(self.exp_log,'ab')
+
+        # write the logs from a background thread, along with an
+        # index for random access (see log.LogIndex)
+        self.state_log_writer = writer(self.state_log_stream,
+                                       index_stream=open(self.state_log+
+                                                         INDEX_EXT,'ab'))
+        self.exp_log_writer = writer(self.exp_log_stream,
+                                     index_stream=open(self.exp_log+
+                                                       INDEX_EXT,'ab'))
+
+        # writers for custom log files (see Log state), and the
+        # (log_file, writer) of those closed but maybe still writing
+        self._log_writers = {}
+        self._draining_writers = []
+
+        # if we never get to close them in run (e.g., the script raises
+        # before it), close them at exit so the queues are written out
+        atexit.register(_close_logs_at_exit, weakref.ref(self))
+
+        # accumulate the logs as columns if desired
+        if self.numpy:
+            if not have_numpy:
+                raise ImportError("You must install numpy to save columns.")
+            self.column_store = ColumnStore()
+            self.state_log_writer.sinks.append(self.column_store)
+            self.exp_log_writer.sinks.append(self.column_store)
+        else:
+            self.column_store = None
+
+    def _get_screen(self):
+        # no display is needed when simulating
+        if self.simulate:
+            return None
+        screens = pyglet.window.get_platform().get_default_display().get_screens()
+        return screens[self.screen_ind]
+
     def _process_args(self):
         # set up the arg parser
         parser = argparse.ArgumentParser(description='Run a SMILE experiment.')
@@ -220,6 +291,25 @@ class Experiment(Serial):
         parser.add_argument("-c", "--csv", 
                             help="perform automatic conversion of yaml logs to csv", 
                             action='store_true')   
+        parser.add_argument("-b", "--binary", 
+                            help="write compact binary logs instead of yaml", 
+                            action='store_true')   
+        parser.add_argument("-n", "--numpy", 
+                            help="also save the logs as numpy columns", 
+                            action='store_true')   
+        parser.add_argument("-p", "--profile_refs", 
+                            help="profile Ref evaluation and save a report", 
+                            action='store_true')   
+        parser.add_argument("-sim", "--simulate", 
+                            help="run headless on a virtual clock with simulated responses", 
+                            action='store_true')   
+        parser.add_argument("-r", "--responses", 
+                            help="file of scripted responses for simulating", 
+                            default=None)        
+        parser.add_argument("--seed", 
+                            help="seed for the random numbers (e.g., shuffles and jitter)", 
+                            type=int,
+                            default=None)        
 
         # do the parsing
         args = parser.parse_args()
@@ -241,11 +331,199 @@ class Experiment(Serial):
 
         # set whether to log csv
         self.csv = args.csv
+
+        # set whether to write binary logs
+        self.binary = args.binary
+
+        # set whether to save numpy columns
+        self.numpy = args.numpy
+
+        # set whether to profile the Refs
+        self.profile_refs = args.profile_refs
+
+        # set whether to simulate
+        self.simulate = args.simulate or not args.responses is None
+        self.responses = args.responses
+
+        # seed the random numbers if desired
+        self.seed = args.seed
+        if not self.seed is None:
+            random.seed(self.seed)
         
+    def __getstate__(self):
+        # leave out the window, clock, and logs, which are set up again
+        # when it's loaded
+        state = super(Experiment, self).__getstate__()
+        for name in ('screen', 'clock', 'window', 'state_log_stream', 
+                     'exp_log_stream', 'state_log_writer', 'exp_log_writer',
+                     '_log_writers', '_draining_writers', 'column_store'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # process the args for this run (e.g., a new subject)
+        fullscreen = self.fullscreen
+        self._process_args()
+        self.fullscreen = fullscreen or self.fullscreen
+
+        # set up everything that wasn't saved
+        self.screen = self._get_screen()
+        self.window = None
+        self.clock = pyglet.clock._default
+        self.__class__.last_instance = weakref.ref(self)
+        self._open_logs()
+
+    def save(self, filename):
+        """
+        Save the experiment, with all its states, to a file so it can
+        be loaded and run later without building it again.
+
+        Example
+        -------
+        if os.path.exists('exp.pkl'):
+            exp = Experiment.load('exp.pkl')
+        else:
+            exp = Experiment()
+            ... # build the states
+            exp.save('exp.pkl')
+        exp.run()
+        """
+        with open(filename, 'wb') as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an experiment saved with `save`. The command line args
+        are processed again, so it can be run for a new subject.
+        """
+        with open(filename, 'rb') as f:
+            return cPickle.load(f)
+
     def run(self):
         """
         Run the experiment.
+
+        When simulating (see the --simulate flag) there is no window
+        and the states run on a virtual clock. Whenever a pass through
+        the event loop has nothing to do, the clock jumps ahead to the
+        next scheduled callback, and the key and mouse presses come
+        from the responder.
         """
+        if self.simulate:
+            self._setup_simulation()
+        else:
+            self._setup_window()
+
+        # first clear and do a flip
+        #glClear(GL_COLOR_BUFFER_BIT)
+        self.window.on_draw(force=True)
+        self.blocking_flip()
+
+        # turn on the Ref cache if desired, sharing identical Refs
+        # across states so they can use each other's cached values
+        enable_cache(self.ref_cache)
+        if self.ref_cache:
+            sharer = self._share_refs()
+            print "Merged %d duplicate Refs into %d shared Refs" % \
+                (sharer.merged, len(sharer.shared()))
+
+        # time the Refs if desired, labeling them by state and attr
+        if self.profile_refs:
+            profiler = RefProfiler()
+            for state, name, value in self._iter_state_attrs():
+                profiler.add_owner(value, 
+                                   get_class_name(state)[0]+'.'+name)
+            profiler.start()
+
+        try:
+            # start the first state (that's this experiment)
+            self.enter()
+
+            # process events until done
+            sched = scheduler._default
+            self._last_time = now()
+            while not self.done and not self.window.has_exit:
+                # new tick, so cached Ref values are stale
+                invalidate()
+
+                # record the time range
+                self._new_time = now()
+                time_err = (self._new_time - self._last_time)/2.
+                self.event_time = event_time(self._last_time+time_err,
+                                             time_err)
+
+                # process the events that occurred in that range
+                nops = sched.nops
+                self.window.dispatch_events()
+
+                # handle all scheduled state callbacks
+                dt = scheduler.tick()
+
+                if self.simulate:
+                    if sched.nops == nops:
+                        # nothing happened, so skip ahead to the next
+                        # callback (or a flip if there isn't one)
+                        next_time = sched.next_time()
+                        if next_time is None:
+                            self._vclock.advance(self.flip_interval)
+                        else:
+                            self._vclock.advance_to(next_time)
+
+                        # the jump is not a range that events occur in
+                        self._new_time = now()
+                else:
+                    # let pyglet run its own callbacks (e.g., media
+                    # players)
+                    clock.tick(poll=True)
+
+                    # put in sleeps if necessary
+                    if dt < .0001:
+                        # do a usleep for 1/4 of a ms (might need to tweak)
+                        self.clock.sleep(250)
+
+                # save the time
+                self._last_time = self._new_time
+        finally:
+            # drain and close the log writers, even if something went
+            # wrong, so every record makes it to disk
+            self.close_log_writers()
+            enable_cache(False)
+            if self.simulate:
+                # back to real time
+                scheduler.set_clock(None)
+
+        if self.ref_cache:
+            print "Shared Refs were read from the cache %d times" % \
+                sharer.saved()
+
+        # save the Ref profile
+        if self.profile_refs:
+            profiler.stop()
+            report = profiler.report(limit=None)
+            with open(os.path.join(self.subj_dir,'ref_profile.txt'),'w') as f:
+                f.write(report+'\n')
+            profiler.write_collapsed(os.path.join(self.subj_dir,
+                                                  'ref_profile.folded'))
+            print '\n'.join(report.split('\n')[:21])
+
+        # save the columns for analysis
+        if not self.column_store is None:
+            self.column_store.save(os.path.join(self.subj_dir,'columns'))
+
+        # close the window and clean up
+        self.window.close()
+        self.window = None
+
+        # write out csv logs if desired (after the window is gone)
+        if self.csv:
+            log2csv(self.state_log)
+            log2csv(self.exp_log)
+
+
+    def _setup_window(self):
         # create the window
         if self.fullscreen:
             self.window = ExpWindow(self, fullscreen=True, 
@@ -267,6 +545,8 @@ class Experiment(Serial):
         self.window.set_mouse_visible(False)
 
         # some gl stuff (must look up to remember why we want them)
+        from pyglet.gl import glEnable, glBlendFunc, GL_BLEND, \
+            GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 
@@ -274,48 +554,110 @@ class Experiment(Serial):
         self.flip_interval = self._calc_flip_interval()
         print "Monitor Flip Interval is %f (%f Hz)"%(self.flip_interval,1./self.flip_interval)
 
-        # first clear and do a flip
-        #glClear(GL_COLOR_BUFFER_BIT)
-        self.window.on_draw(force=True)
-        self.blocking_flip()
-
-        # start the first state (that's this experiment)
-        self.enter()
-
-        # process events until done
-        self._last_time = now()
-        while not self.done and not self.window.has_exit:
-            # record the time range
-            self._new_time = now()
-            time_err = (self._new_time - self._last_time)/2.
-            self.event_time = event_time(self._last_time+time_err,
-                                         time_err)
-
-            # process the events that occurred in that range
-            self.window.dispatch_events()
-
-            # handle all scheduled callbacks
-            dt = clock.tick(poll=True)
-
-            # put in sleeps if necessary
-            if dt < .0001:
-                # do a usleep for 1/4 of a ms (might need to tweak)
-                self.clock.sleep(250)
-
-            # save the time
-            self._last_time = self._new_time
-
-        # write out csv logs if desired
-        if self.csv:
-            self.state_log_stream.flush()
-            yaml2csv(self.state_log, os.path.splitext(self.state_log)[0]+'.csv')
-            self.exp_log_stream.flush()
-            yaml2csv(self.exp_log, os.path.splitext(self.exp_log)[0]+'.csv')
-
-        # close the window and clean up
-        self.window.close()
-        self.window = None
-
+    def _setup_simulation(self):
+        # pick the responses
+        responder = self.responder
+        if responder is None:
+            if self.responses:
+                responder = ScriptedResponder.from_file(self.responses)
+            else:
+                responder = RandomResponder()
+
+        # no drawing, so just pretend to have a window
+        self.window = SimWindow(self, responder, *(self.resolution))
+
+        # run the states on a clock that only moves when we move it
+        self._vclock = VirtualClock()
+        scheduler.set_clock(self._vclock)
+        print "Simulating on a virtual clock"
+
+    def _iter_state_attrs(self):
+        # go through the attributes of all the states (other than
+        # their links to other states)
+        states = [self]
+        seen = set([id(self)])
+        while states:
+            state = states.pop()
+            for name, value in state.__dict__.items():
+                if name in ('parent', 'exp'):
+                    continue
+                if name == 'children' or isinstance(value, State):
+                    # more states to search
+                    if isinstance(value, State):
+                        value = [value]
+                    for c in value:
+                        if not id(c) in seen:
+                            seen.add(id(c))
+                            states.append(c)
+                    continue
+                yield state, name, value
+
+    def _share_refs(self):
+        # merge identical Ref subtrees held by any of the states
+        sharer = RefSharer()
+        for state, name, value in self._iter_state_attrs():
+            new = sharer.share(value)
+            if not new is value:
+                setattr(state, name, new)
+        return sharer
+
+    def get_log_writer(self, log_file):
+        """
+        Get the background writer for a custom log file in the subject
+        directory, opening it the first time it is requested.
+        """
+        writer = self._log_writers.get(log_file)
+        if writer is None:
+            # let an earlier writer for this file finish, so there's
+            # only ever one appending to it
+            for old_file, old_writer in self._draining_writers:
+                if old_file == log_file:
+                    try:
+                        old_writer.join()
+                    except IOError:
+                        # it's raised again by close_log_writers
+                        pass
+
+            # open it with a big buffer to append to
+            filename = os.path.join(self.subj_dir, log_file)
+            if os.path.splitext(log_file)[1] == BINARY_EXT:
+                writer = BinaryLogWriter(open(filename, 'ab', 65536))
+            else:
+                writer = LogWriter(open(filename, 'ab', 65536))
+            self._log_writers[log_file] = writer
+        return writer
+
+    def close_log_writer(self, log_file, wait=False):
+        """
+        Close the writer for a custom log file. By default the queued
+        records are written out in the background.
+        """
+        writer = self._log_writers.pop(log_file, None)
+        if not writer is None:
+            writer.close(wait=wait)
+            if not wait:
+                # make sure it's done before we exit
+                self._draining_writers.append((log_file, writer))
+
+    def close_log_writers(self):
+        """
+        Drain and close all the log writers. Raises an IOError if any
+        records could not be written (after closing all of them).
+        """
+        writers = [self._log_writers.pop(log_file)
+                   for log_file in self._log_writers.keys()]
+        writers += [writer for log_file, writer in self._draining_writers]
+        self._draining_writers = []
+        writers += [self.state_log_writer, self.exp_log_writer]
+        error = None
+        for writer in writers:
+            try:
+                writer.close()
+            except IOError, e:
+                if error is None:
+                    error = e
+        if not error is None:
+            raise error
 
     def _calc_flip_interval(self, nflips=55, nignore=5):
         """
@@ -358,12 +700,18 @@ class Experiment(Serial):
         
     def blocking_flip(self):
         # only flip if we've drawn
-        if self.window.need_flip:
+        if self.window.need_flip and self.simulate:
+            # nothing to wait for
+            self.last_flip = event_time(now(),0.0)
+            self.window.need_flip = False
+        elif self.window.need_flip:
             # first the flip
             self.window.flip()
 
             if True: #not self.pyglet_vsync:
                 # OpenGL:
+                from pyglet.gl import glDrawBuffer, glColor4f, glBegin, \
+                    glVertex2i, glEnd, glFinish, GL_BACK, GL_POINTS
                 glDrawBuffer(GL_BACK)
                 # We draw our single pixel with an alpha-value of zero
                 # - so effectively it doesn't change the color buffer
@@ -387,6 +735,14 @@ class Experiment(Serial):
         return self.last_flip
 
 
+def _close_logs_at_exit(exp_ref):
+    # close the log writers of an experiment that didn't (see
+    # Experiment._open_logs), before their threads are killed
+    exp = exp_ref()
+    if not exp is None and exp.state_log_writer.is_alive():
+        exp.close_log_writers()
+
+
 class Set(State, RunOnEnter):
     """
     State to set a experiment variable.
@@ -440,10 +796,13 @@ class Set(State, RunOnEnter):
             self.variable = val(self.var)
         else:
             self.variable = self.var
-        self.value = val(self.val)
+        # copy any containers, so changing them later doesn't change
+        # the variable
+        self.value = snapshot(val(self.val))
         if isinstance(self.variable, str):
             # set the experiment variable
             self.exp._vars[self.variable] = self.value
+            invalidate()
         elif isinstance(self.variable, Ref):
             # set the ref
             self.variable.set(self.value)
@@ -490,8 +849,12 @@ def Get(variable):
     recorded in the state.yaml and state.csv files. Refer to State class
     docstring for addtional logged parameters. 
     """
-    gfunc = lambda : Experiment.last_instance()._vars[val(variable)]
-    return Ref(gfunc=gfunc)
+    return Ref(gfunc=_get_var, gfunc_args=(variable,))
+
+@pure
+def _get_var(variable):
+    # Set invalidates the Ref cache, so this can be cached
+    return Experiment.last_instance()._vars[variable]
 
 
 class Log(State, RunOnEnter):
@@ -503,8 +866,12 @@ class Log(State, RunOnEnter):
     ----------
     log_dict : dict
         Key-value pairs to log. Handy for logging trial information.
-    log_file : str, optional
+    log_file : {str, Ref}, optional
         Where to log, defaults to exp.yaml in the subject directory.
+        Open files are kept for the whole experiment, and a Ref that
+        evaluates to a new file name (e.g., one per block) closes the
+        previous file. Files ending in .slog are written in the
+        binary log format.
     parent : {None, ``ParentState``}
         Parent state to attach to. Will search for experiment if None.
     **log_items : kwargs
@@ -570,16 +937,21 @@ class Log(State, RunOnEnter):
                                   duration=0,
                                   save_log=False)
         self.log_file = log_file
+        self._last_log_file = None
         self.log_items = log_items
         self.log_dict = log_dict
 
-    def _get_stream(self):
-        if self.log_file is None:
-            stream = self.exp.exp_log_stream
-        else:
-            # make it from the name
-            stream = open(os.path.join(self.exp.subj_dir,self.log_file),'a')
-        return stream
+    def _get_writer(self):
+        log_file = val(self.log_file)
+        if log_file is None:
+            return self.exp.exp_log_writer
+        if not self._last_log_file is None and \
+           log_file != self._last_log_file:
+            # we've moved on to a new file (e.g., one per block), so
+            # let the old one finish up and close
+            self.exp.close_log_writer(self._last_log_file)
+        self._last_log_file = log_file
+        return self.exp.get_log_writer(log_file)
         
     def _callback(self, dt):
         # eval the log_items and write the log
@@ -587,10 +959,10 @@ class Log(State, RunOnEnter):
         log = dict(keyvals)
         if self.log_dict:
             log.update(val(self.log_dict))
-        # log it to the correct file
-        dump([log], self._get_stream())
+        # hand a copy off to the writer for the correct file, since
+        # it's written later
+        self._get_writer().write(snapshot(log))
         pass
-    
             
 if __name__ == '__main__':
     # can't run inside this file
@@ -7,10 +7,13 @@
 #
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
+from utils import setup_pyglet
+setup_pyglet()
 from pyglet.window import key
 
 from state import State
-from ref import Ref, val
+from scheduler import wake_at
+from ref import Ref, val, invalidate
 
 # get the last instance of the experiment class
 from experiment import Experiment, now
@@ -132,20 +135,26 @@ class KeyPress(State):
             if self.pressed in correct_resp:
                 self.correct = True
 
+            # drop the cached values of Refs that read the response
+            invalidate(self)
+
             # let's leave b/c we're all done
             #self.interval = 0
             self.leave()
             
     def _callback(self, dt):
-        if not self.waiting:
-            self.exp.window.key_callbacks.append(self._key_callback)
-            self.waiting = True
         if self.base_time is None:
             self.base_time = val(self.base_time_src)
             if self.base_time is None:
                 # set it to the state time
                 self.base_time = self.state_time
         wait_duration = val(self.wait_duration)
+        if not self.waiting:
+            self.exp.window.key_callbacks.append(self._key_callback)
+            self.waiting = True
+            if not wait_duration is None:
+                # make sure there's a tick at the timeout
+                wake_at(self.base_time+wait_duration)
         if (not wait_duration is None) and (now() >= self.base_time+wait_duration):
             self.leave()
         elif val(self.wait_until):
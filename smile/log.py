@@ -10,7 +10,18 @@
 
 import yaml
 import csv
-#import sys
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+from operator import itemgetter
+import cPickle
+import time
+import threading
+import Queue
+import traceback
+import zlib
+import sys
 
 # set up a dumper that does not do anchors or aliases
 if hasattr(yaml,'CSafeDumper'):
@@ -21,6 +32,609 @@ Dumper.ignore_aliases = lambda self, data: True
 def dump(logline, stream=None):
     return yaml.dump(logline, stream, Dumper=Dumper)
 
+# and a fast loader to read them back in
+if hasattr(yaml,'CSafeLoader'):
+    Loader = yaml.CSafeLoader
+else:
+    Loader = yaml.SafeLoader
+
+
+class LogWriter(object):
+    """
+    Write log records to a stream from a background thread.
+
+    Records are handed off through a bounded queue so that the
+    serialization and the file write happen outside of the clock
+    callbacks that schedule flips and timestamp responses.
+
+    Parameters
+    ----------
+    stream : file
+        Open stream to append the records to.
+    maxsize : int
+        Maximum number of records waiting to be written. If the
+        queue fills up, writing a record blocks until there is room.
+    flush_interval : float
+        Seconds between commits of the records written so far.
+    index_stream : file
+        Optional binary stream for a sidecar index of the byte offset
+        of each record along with its state, enclosing loop
+        iterations, and start and end times (see `LogIndex`).
+    sync : bool
+        Whether each commit also syncs the stream to disk, so that
+        at most flush_interval seconds of records can be lost if the
+        computer goes down.
+
+    Records are committed in groups from the writer thread, so a
+    commit never holds up the frame loop. The index is committed
+    before the log so it always covers every record that made it to
+    disk, which is what `recover_log` uses to tell a complete trailing
+    record from a truncated one.
+
+    Objects in the `sinks` list (e.g., a ColumnStore) have their
+    append_rows method called from the writer thread with each batch
+    of (fields, row) records after it is written.
+
+    Each record is serialized on its own, so one that can't be (e.g.,
+    it holds an object yaml can't represent) is skipped without losing
+    the rest of its batch, and only whole records reach the stream.
+    The skipped records are counted in num_skipped and `close` raises
+    an IOError about them.
+    """
+    def __init__(self, stream, maxsize=10000, flush_interval=1.0,
+                 index_stream=None, sync=True):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.sync = sync
+        self.sinks = []
+
+        # keep track of where we are in the file for the index
+        self.index_stream = index_stream
+        self._index_cols = {}
+        self._offset = 0
+        if not self.index_stream is None:
+            self.stream.seek(0, 2)
+            self._offset = self.stream.tell()
+            self.index_stream.write(_pack_record('H', BINARY_VERSION))
+        self._queue = Queue.Queue(maxsize)
+        self._closed = False
+
+        # records that could not be written and the first error
+        self.num_skipped = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        """
+        Queue a log record (dict) to be written.
+        """
+        self._queue.put((tuple(record.keys()), tuple(record.values()), 
+                         None))
+
+    def write_row(self, fields, row, loops=None):
+        """
+        Queue a log record, given as a tuple of field names and a
+        matching tuple of values, to be written. The iterations of the
+        enclosing loops can be passed in for the index.
+        """
+        self._queue.put((fields, row, loops))
+
+    def _pack(self, fields, row, loops, offset):
+        # the yaml for one record (as a continuation of the yaml list)
+        # and its index entry
+        chunk = dump([dict(zip(fields, row))])
+        if self.index_stream is None:
+            return chunk, ''
+        return chunk, self._index_entry(offset, len(chunk), 
+                                        fields, row, loops)
+
+    def _write_records(self, records):
+        # serialize them one at a time, so a bad record only loses
+        # itself, then write the whole ones
+        chunks = []
+        entries = []
+        written = []
+        offset = self._offset
+        for fields, row, loops in records:
+            try:
+                chunk, entry = self._pack(fields, row, loops, offset)
+            except Exception, e:
+                self._skip(fields, row, e)
+                continue
+            chunks.append(chunk)
+            entries.append(entry)
+            written.append((fields, row))
+            offset += len(chunk)
+
+        # the index goes first, so it never points past the log
+        if not self.index_stream is None:
+            self.index_stream.write(''.join(entries))
+            self._offset = offset
+        self.stream.write(''.join(chunks))
+        return written
+
+    def _skip(self, fields, row, e):
+        # report a record that can't be written and keep the error
+        # for close
+        self.num_skipped += 1
+        if self._error is None:
+            self._error = e
+        state = row[fields.index('state')] if 'state' in fields else None
+        sys.stderr.write('Skipped a log record%s that could not be '
+                         'written: %s\n' % 
+                         ('' if state is None else ' of '+str(state), e))
+
+    def _index_entry(self, offset, length, fields, row, loops,
+                     schema_id=None):
+        # the index entry for a record at offset
+        cols = self._index_cols.get(fields)
+        if cols is None:
+            cols = tuple([fields.index(f) if f in fields else None
+                          for f in ('state', 'start_time', 'end_time')])
+            self._index_cols[fields] = cols
+        state, start_time, end_time = [None if c is None else row[c] 
+                                       for c in cols]
+        return _pack_record('I', (offset, length, schema_id, state, loops,
+                                  start_time, end_time))
+
+    def _run(self):
+        last_flush = time.time()
+        dirty = False
+        while True:
+            # wait for a record, then grab whatever else is waiting
+            try:
+                records = [self._queue.get(timeout=self.flush_interval)]
+            except Queue.Empty:
+                records = []
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            # a None record means we're closing
+            done = None in records
+            records = [r for r in records if not r is None]
+            try:
+                if records:
+                    rows = self._write_records(records)
+                    dirty = True
+                    if self.sinks and rows:
+                        for sink in self.sinks:
+                            sink.append_rows(rows)
+                if dirty and (done or 
+                              time.time()-last_flush >= self.flush_interval):
+                    # group commit so the file keeps up with the session
+                    self._commit()
+                    last_flush = time.time()
+                    dirty = False
+            except Exception, e:
+                # report it, but keep the thread alive to drain the queue
+                traceback.print_exc()
+                if self._error is None:
+                    self._error = e
+            for i in range(len(records) + done):
+                self._queue.task_done()
+            if done:
+                self.stream.close()
+                if not self.index_stream is None:
+                    self.index_stream.close()
+                break
+
+    def _commit(self):
+        # the index goes first so it never misses a record in the log
+        streams = [self.stream]
+        if not self.index_stream is None:
+            streams.insert(0, self.index_stream)
+        for stream in streams:
+            stream.flush()
+            if self.sync:
+                try:
+                    os.fsync(stream.fileno())
+                except (AttributeError, OSError):
+                    # not a real file (e.g., a StringIO)
+                    pass
+
+    def flush(self):
+        """
+        Wait until all queued records are written and flush the stream.
+        """
+        self._queue.join()
+        if not self.stream.closed:
+            self.stream.flush()
+
+    def close(self, wait=True):
+        """
+        Write out any queued records, stop the thread, and close the
+        stream. If wait is False, return right away and let the thread
+        finish up in the background (see `join`).
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+        if wait:
+            self.join()
+
+    def join(self):
+        """
+        Wait for a closed writer to finish. Raises an IOError if any
+        records could not be written.
+        """
+        self._thread.join()
+        if not self._error is None:
+            raise IOError('%d log record(s) could not be written to %s '
+                          '(first error: %s)' % 
+                          (self.num_skipped, 
+                           getattr(self.stream, 'name', 'the log'),
+                           self._error))
+
+    def is_alive(self):
+        """
+        Whether the writer thread is still writing.
+        """
+        return self._thread.is_alive()
+
+
+# binary log records are a type code, payload length, and crc32 of
+# the payload followed by the pickled payload
+BINARY_EXT = '.slog'
+BINARY_VERSION = 1
+_record_header = struct.Struct('<cII')
+_record_types = 'HSRI'
+
+def _pack_record(rtype, payload):
+    payload = cPickle.dumps(payload, cPickle.HIGHEST_PROTOCOL)
+    return _record_header.pack(rtype, len(payload), 
+                               zlib.crc32(payload) & 0xffffffff) + payload
+
+
+class BinaryLogWriter(LogWriter):
+    """
+    Write log records in a compact, length-prefixed binary format.
+
+    Each distinct tuple of fields (e.g., the log schema of a State
+    subclass) is written once as a schema record and every log record
+    after that is only a schema id and a tuple of values, so the
+    stream is fast to write and to read back. Use `read_records` to
+    stream the records back as dicts and `bin2yaml` or `bin2csv` to
+    export them.
+
+    Parameters
+    ----------
+    stream : file
+        Open binary stream to append the records to.
+    maxsize : int
+        Maximum number of records waiting to be written.
+    flush_interval : float
+        Seconds between commits of the records written so far.
+    index_stream : file
+        Optional binary stream for a sidecar index (see `LogIndex`).
+    sync : bool
+        Whether each commit also syncs the stream to disk.
+
+    Every record carries a crc32 of its payload, so a damaged record
+    is detected instead of being unpickled into garbage.
+    """
+    def __init__(self, stream, maxsize=10000, flush_interval=1.0,
+                 index_stream=None, sync=True):
+        # schema ids restart with each header, so appending to an
+        # existing file is fine
+        self._schemas = {}
+        stream.write(_pack_record('H', BINARY_VERSION))
+        super(BinaryLogWriter, self).__init__(stream, maxsize=maxsize,
+                                              flush_interval=flush_interval,
+                                              index_stream=index_stream,
+                                              sync=sync)
+
+    def _pack(self, fields, row, loops, offset):
+        # the record (after its schema, the first time we've seen
+        # these fields) and its index entry, which needs the schema, too
+        schema_id = self._schemas.get(fields)
+        schema = ''
+        if schema_id is None:
+            schema_id = len(self._schemas)
+            schema = _pack_record('S', (schema_id, fields))
+        rec = _pack_record('R', (schema_id, row))
+        entry = ''
+        if not self.index_stream is None:
+            entry = schema + self._index_entry(offset+len(schema), len(rec),
+                                               fields, row, loops, schema_id)
+
+        # only keep the schema once the record is sure to be written
+        self._schemas[fields] = schema_id
+        return schema+rec, entry
+
+
+INDEX_EXT = '.idx'
+
+def _iter_packed(stream, strict=True, name='stream'):
+    # iterate over the (type, payload) records of a binary stream,
+    # stopping at a truncated record. if not strict, damaged records
+    # are skipped by scanning forward a byte at a time for the next
+    # record with a good checksum.
+    pos = stream.tell()
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(pos)
+    bad_start = None
+    while True:
+        pos = stream.tell()
+        header = stream.read(_record_header.size)
+        if len(header) < _record_header.size:
+            break
+        rtype, length, crc = _record_header.unpack(header)
+        if pos + _record_header.size + length > size:
+            # runs past the end of the file
+            if strict:
+                break
+        elif rtype in _record_types:
+            payload = stream.read(length)
+            if zlib.crc32(payload) & 0xffffffff == crc:
+                try:
+                    record = cPickle.loads(payload)
+                except Exception:
+                    pass
+                else:
+                    if not bad_start is None:
+                        _warn_skipped(name, bad_start, pos-bad_start)
+                        bad_start = None
+                    yield rtype, record
+                    continue
+        if strict:
+            raise ValueError('Damaged record at byte %d of %s.' % (pos, name))
+        if bad_start is None:
+            bad_start = pos
+        stream.seek(pos+1)
+    if not bad_start is None:
+        _warn_skipped(name, bad_start, size-bad_start)
+
+def _warn_skipped(name, offset, nbytes):
+    sys.stderr.write("WARNING: Skipped %d damaged bytes at byte %d of %s.\n" %
+                     (nbytes, offset, name))
+
+
+def read_rows(bin_file, strict=True):
+    """
+    Stream the records of a binary log file as (fields, row) tuples.
+
+    A truncated record at the end of the file (e.g., from a crash) is
+    ignored. A damaged record raises a ValueError unless strict is
+    False, in which case it is skipped with a warning and every intact
+    record after it is still read.
+    """
+    with open(bin_file, 'rb') as fin:
+        schemas = {}
+        for rtype, payload in _iter_packed(fin, strict=strict, 
+                                           name=bin_file):
+            if rtype == 'R':
+                fields = schemas.get(payload[0])
+                if fields is None:
+                    if strict:
+                        raise ValueError('Unknown schema %r in %s.' %
+                                         (payload[0], bin_file))
+                    # its schema record was damaged
+                    continue
+                yield fields, payload[1]
+            elif rtype == 'S':
+                schemas[payload[0]] = payload[1]
+            elif rtype == 'H':
+                # new writer, so start the schemas over
+                if payload > BINARY_VERSION:
+                    raise ValueError('Unsupported binary log version %d.' %
+                                     payload)
+                schemas = {}
+            else:
+                raise ValueError('Unrecognized record type %r in %s.' %
+                                 (rtype, bin_file))
+
+def read_records(bin_file, strict=True, **append_cols):
+    """
+    Stream the records of a binary log file as dicts.
+
+    A truncated record at the end of the file (e.g., from a crash) is
+    ignored. Damaged records are skipped if strict is False (see
+    `read_rows`).
+    """
+    for fields, row in read_rows(bin_file, strict=strict):
+        record = dict(zip(fields, row))
+        record.update(append_cols)
+        yield record
+
+
+class LogIndex(object):
+    """
+    Random access into a yaml or binary log through its sidecar index.
+
+    The index is written alongside the log (e.g., state.yaml.idx) and
+    holds the byte offset of every record along with its state class,
+    the iterations of its enclosing loops (outermost first), and its
+    start and end times. Only the selected records are read from the
+    log and decoded.
+
+    Parameters
+    ----------
+    log_file : str
+        The yaml or binary log.
+    index_file : str, optional
+        The index, defaults to the log_file with .idx appended.
+
+    Example
+    -------
+    idx = LogIndex('data/test000/state.yaml')
+    # all the key presses in the fourth iteration of the outer loop
+    presses = list(idx.read(state='KeyPress', loops=(3,)))
+    """
+    def __init__(self, log_file, index_file=None):
+        self.log_file = log_file
+        if index_file is None:
+            index_file = log_file + INDEX_EXT
+        self.index_file = index_file
+        self.binary = os.path.splitext(log_file)[1] == BINARY_EXT
+
+        # load the entries, resolving the schemas as we go and leaving
+        # out records that never made it into the log
+        self.entries = []
+        self._by_state = {}
+        schemas = {}
+        log_size = os.path.getsize(self.log_file)
+        with open(self.index_file, 'rb') as fin:
+            for rtype, payload in _iter_packed(fin, strict=False, 
+                                               name=self.index_file):
+                if rtype == 'I':
+                    offset, length, schema_id, state, loops, start, end = payload
+                    if offset + length > log_size:
+                        continue
+                    entry = (offset, length, schemas.get(schema_id), 
+                             state, loops, start, end)
+                    self.entries.append(entry)
+                    self._by_state.setdefault(state, []).append(entry)
+                elif rtype == 'S':
+                    schemas[payload[0]] = payload[1]
+                elif rtype == 'H':
+                    schemas = {}
+
+    def states(self):
+        """
+        The state classes in the index.
+        """
+        return self._by_state.keys()
+
+    def select(self, state=None, loops=None, start=None, end=None):
+        """
+        Select index entries.
+
+        Parameters
+        ----------
+        state : str
+            Only records from this state class.
+        loops : tuple
+            Only records whose enclosing loop iterations start with
+            these values (outermost first). None matches any
+            iteration, so (None, 2) is the third iteration of the inner
+            loop in every iteration of the outer loop.
+        start, end : float
+            Only records whose start_time is in [start, end).
+
+        Returns a list of (offset, length, fields, state, loops,
+        start_time, end_time) entries.
+        """
+        if state is None:
+            entries = self.entries
+        else:
+            entries = self._by_state.get(state, [])
+        if not loops is None:
+            loops = tuple(loops)
+            entries = [e for e in entries 
+                       if not e[4] is None and len(e[4]) >= len(loops) and
+                       all([l is None or l == el 
+                            for l, el in zip(loops, e[4])])]
+        if not start is None:
+            entries = [e for e in entries 
+                       if not e[5] is None and e[5] >= start]
+        if not end is None:
+            entries = [e for e in entries 
+                       if not e[5] is None and e[5] < end]
+        return entries
+
+    def read(self, **kwargs):
+        """
+        Read the selected records (see `select`) from the log as dicts.
+        """
+        entries = self.select(**kwargs)
+        with open(self.log_file, 'rb') as fin:
+            for offset, length, fields, state, loops, start, end in entries:
+                fin.seek(offset)
+                chunk = fin.read(length)
+                if self.binary:
+                    schema_id, row = cPickle.loads(
+                        chunk[_record_header.size:])
+                    yield dict(zip(fields, row))
+                else:
+                    yield yaml.load(chunk, Loader=Loader)[0]
+
+
+def _untuple(x):
+    # match what comes back from the yaml logs
+    if isinstance(x, (tuple, list)):
+        return [_untuple(v) for v in x]
+    elif isinstance(x, dict):
+        return {k:_untuple(v) for k,v in x.iteritems()}
+    return x
+
+def bin2dl(bin_file, **append_cols):
+    # read in the records and unwrap them like the yaml logs
+    return [unwrap(_untuple(r)) for r in read_records(bin_file, **append_cols)]
+
+def bin2yaml(bin_file, yaml_file):
+    """
+    Export a binary log to the standard yaml log format.
+    """
+    with open(yaml_file, 'w') as fout:
+        for record in read_records(bin_file):
+            dump([record], fout)
+
+def bin2csv(bin_file, csv_file, batch_size=1000, strict=True, 
+            **append_cols):
+    """
+    Export a binary log to a csv file, skipping damaged records if
+    strict is False.
+    """
+    return _write_csv(_row_batches(read_rows(bin_file, strict=strict), 
+                                   batch_size,
+                                   unwrap_tuples=False, **append_cols),
+                      csv_file)
+
+def log2csv(log_file, csv_file=None, strict=True, **append_cols):
+    """
+    Convert a yaml or binary log to a csv file, defaulting to the
+    same name with a .csv extension. Returns the number of rows
+    written. If strict is False, records damaged by a crash are
+    skipped with a warning instead of failing the whole conversion.
+    """
+    base, ext = os.path.splitext(log_file)
+    if csv_file is None:
+        csv_file = base+'.csv'
+    if ext == BINARY_EXT:
+        return bin2csv(log_file, csv_file, strict=strict, **append_cols)
+    else:
+        return yaml2csv(log_file, csv_file, strict=strict, **append_cols)
+
+def merge2csv(log_files, csv_file, batch_size=1000, strict=True):
+    """
+    Merge yaml and/or binary logs (e.g., the exp logs of many
+    subjects) into a single csv file in one pass.
+
+    Parameters
+    ----------
+    log_files : list
+        List of (log_file, append_cols) tuples, where append_cols is a
+        dict of columns to add to each record of that log (e.g., the
+        subject).
+    csv_file : str
+        Where to write the merged csv.
+
+    Example
+    -------
+    merge2csv([('data/s000/exp.yaml', {'subject':'s000'}),
+               ('data/s001/exp.yaml', {'subject':'s001'})],
+              'data/all_exp.csv')
+
+    Returns the number of rows written.
+    """
+    def records():
+        for log_file, append_cols in log_files:
+            if os.path.splitext(log_file)[1] == BINARY_EXT:
+                for r in read_records(log_file, strict=strict, 
+                                      **append_cols):
+                    yield _untuple(r)
+            else:
+                for d in iter_yaml(log_file, batch_size=batch_size, 
+                                   strict=strict, **append_cols):
+                    yield d
+    return _write_csv(_row_batches(records(), batch_size), csv_file)
+
 # for eventually writing CSV files with headers
 # from: http://stackoverflow.com/questions/2982023/writing-header-in-csv-python-with-dlictwriter
 """
@@ -33,13 +647,148 @@ with open(outfile,'wb') as fou:
 """
 def load_yaml(yaml_file, **append_cols):
     # load the dictlist
-    dictlist = yaml.load(open(yaml_file,'r'))
+    dictlist = yaml.load(open(yaml_file,'r'), Loader=Loader)
     if dictlist is None:
         return []
     for i in range(len(dictlist)):
         dictlist[i].update(append_cols)
     return dictlist
 
+def iter_yaml(yaml_file, batch_size=1000, strict=True, **append_cols):
+    """
+    Stream the records of a yaml log one at a time.
+
+    The logs are written as one list item per record, so the file is
+    split on the top-level list items and parsed in batches instead of
+    loading the whole file at once.
+
+    If strict is False, records that can't be parsed (e.g., from a
+    crash partway through a write) are skipped with a warning instead
+    of raising an error, so every complete record is still read. See
+    `recover_log` for how a truncated trailing record is detected.
+    """
+    with open(yaml_file,'rb') as fin:
+        chunks = _iter_yaml_chunks(fin)
+        if not strict:
+            chunks = _complete_chunks(chunks, yaml_file)
+        batch = []
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                for d in _load_chunks(batch, strict, yaml_file):
+                    d.update(append_cols)
+                    yield d
+                batch = []
+        if batch:
+            for d in _load_chunks(batch, strict, yaml_file):
+                d.update(append_cols)
+                yield d
+
+def _iter_yaml_chunks(fin):
+    # split a yaml log into (offset, text) chunks, one per top-level
+    # list item
+    lines = []
+    start = offset = 0
+    for line in fin:
+        if line.startswith('-') and lines:
+            # start of a new record
+            yield start, ''.join(lines)
+            lines = []
+            start = offset
+        lines.append(line)
+        offset += len(line)
+    if lines:
+        yield start, ''.join(lines)
+
+def _complete_chunks(chunks, yaml_file):
+    # pass along the chunks, dropping the last one if it was cut off
+    # partway through being written
+    end = _indexed_end(yaml_file)
+    last = None
+    for chunk in chunks:
+        if not last is None:
+            yield last
+        last = chunk
+    if last is None:
+        return
+    offset, text = last
+    if text.endswith('\n') and (end is None or offset+len(text) <= end):
+        yield last
+    elif text.strip():
+        _warn_skipped(yaml_file, offset, len(text))
+
+def _indexed_end(log_file):
+    # the end of the last record in the index that is entirely in the
+    # log, or None if there is no index
+    index_file = log_file + INDEX_EXT
+    if not os.path.exists(index_file):
+        return None
+    log_size = os.path.getsize(log_file)
+    end = 0
+    with open(index_file, 'rb') as fin:
+        for rtype, payload in _iter_packed(fin, strict=False,
+                                           name=index_file):
+            if rtype == 'I' and payload[0] + payload[1] <= log_size:
+                end = max(end, payload[0] + payload[1])
+    return end
+
+def _load_chunks(chunks, strict, yaml_file):
+    # parse a batch of chunks, falling back to one at a time to find
+    # the bad ones if not strict
+    try:
+        dictlist = yaml.load(''.join([text for offset, text in chunks]),
+                             Loader=Loader)
+        return dictlist or []
+    except yaml.YAMLError:
+        if strict:
+            raise
+    dictlist = []
+    for offset, text in chunks:
+        try:
+            dl = yaml.load(text, Loader=Loader)
+        except yaml.YAMLError:
+            dl = None
+        if isinstance(dl, list) and all([isinstance(d, dict) for d in dl]):
+            dictlist.extend(dl)
+        elif text.strip():
+            _warn_skipped(yaml_file, offset, len(text))
+    return dictlist
+
+def recover_log(log_file, out_file=None):
+    """
+    Salvage every complete record from a damaged yaml or binary log.
+
+    Records that were cut off or damaged (e.g., by a crash) are
+    skipped with a warning and the intact ones are written in the same
+    format to out_file, which defaults to the log_file with .recovered
+    before the extension. A trailing record is only kept if the
+    sidecar index (when there is one) shows it was completely written.
+
+    Returns the number of records recovered.
+
+    Example
+    -------
+    recover_log('data/test000/state.yaml')
+    # then convert data/test000/state.recovered.yaml as usual
+    """
+    base, ext = os.path.splitext(log_file)
+    if out_file is None:
+        out_file = base + '.recovered' + ext
+    nrecs = 0
+    if ext == BINARY_EXT:
+        with open(out_file, 'wb') as fout:
+            writer = BinaryLogWriter(fout, sync=False)
+            for fields, row in read_rows(log_file, strict=False):
+                writer.write_row(fields, row)
+                nrecs += 1
+            writer.close()
+    else:
+        with open(out_file, 'w') as fout:
+            for d in iter_yaml(log_file, strict=False):
+                dump([d], fout)
+                nrecs += 1
+    return nrecs
+
 def unwrap(d, prefix=''):
     """
     Process the items of a dict and unwrap them to the top level based
@@ -79,29 +828,237 @@ def yaml2dl(yaml_file, **append_cols):
 
     return dl
 
-def yaml2csv(dictlist, csv_file, **append_cols):
-    # see if dictlist is a yaml file
-    if isinstance(dictlist,str):
-        # assume it's a file and read it in
-        # get the unwraped dict list
-        dictlist = yaml2dl(dictlist, **append_cols)
-    dl = dictlist
+def flatten_rows(fields, rows, unwrap_tuples=True):
+    """
+    Flatten a batch of rows into columns, matching what `unwrap` does
+    to each record.
 
-    if len(dl) == 0:
-        return
+    The nested layout of each field (e.g., event time dicts or
+    tuples) is inferred from its whole column at once and the nested
+    values are pulled out column by column, so the work per record is
+    done by map and itemgetter instead of Python recursion. Fields
+    whose layout changes within the batch fall back to `unwrap`.
 
-    # get all unique colnames
+    Parameters
+    ----------
+    fields : tuple
+        Names of the fields.
+    rows : list of tuples
+        Values in the order of the fields.
+    unwrap_tuples : bool
+        Whether to unwrap tuples into indexed columns or leave them as
+        lists (which is how they come back from the yaml logs).
+
+    Returns a list of column names and a matching list of columns.
+    """
     colnames = []
-    for i in range(len(dl)):
-        for k in dl[i]:
+    columns = []
+    nested = set([dict, tuple]) if unwrap_tuples else set([dict])
+    for i, field in enumerate(fields):
+        _flatten_column(field, map(itemgetter(i), rows), nested,
+                        unwrap_tuples, colnames, columns)
+    return colnames, columns
+
+def _flatten_column(name, col, nested, unwrap_tuples, colnames, columns):
+    types = set(map(type, col))
+    if not types & nested:
+        # nothing to unwrap
+        if tuple in types:
+            col = [_untuple(v) for v in col]
+        colnames.append(name)
+        columns.append(col)
+        return
+    if len(types) == 1:
+        lengths = set(map(len, col))
+        if len(lengths) == 1:
+            # every value has the same size, so try the layout of the
+            # first one
+            if dict in types:
+                keys = col[0].keys()
+            else:
+                keys = range(lengths.pop())
+            try:
+                subcols = [map(itemgetter(k), col) for k in keys]
+            except KeyError:
+                # not the same keys
+                pass
+            else:
+                for k, subcol in zip(keys, subcols):
+                    _flatten_column(name+'_'+str(k), subcol, nested, 
+                                    unwrap_tuples, colnames, columns)
+                return
+
+    # the layout changes, so unwrap them one at a time
+    if unwrap_tuples:
+        flat = [unwrap({name:v}) for v in col]
+    else:
+        flat = [unwrap({name:_untuple(v)}) for v in col]
+    names = OrderedDict()
+    for d in flat:
+        for k in d:
+            names[k] = None
+    for k in names:
+        colnames.append(k)
+        columns.append([d.get(k) for d in flat])
+
+def flatten_records(records, unwrap_tuples=True, colnames=None):
+    """
+    Flatten a batch of log records (dicts or (fields, row) tuples)
+    into rows.
+
+    The records are grouped by their fields and each group is
+    flattened with `flatten_rows`, then the rows are put back in their
+    original order.
+
+    Pass the same OrderedDict as colnames for each batch to keep the
+    columns of later batches in the same order, with new columns
+    added to the end.
+
+    Returns a list of column names and a list of row tuples with the
+    values in that order.
+    """
+    # group by fields, keeping track of where they came from
+    groups = OrderedDict()
+    for i, rec in enumerate(records):
+        if isinstance(rec, dict):
+            fields, row = tuple(rec.keys()), tuple(rec.values())
+        else:
+            fields, row = rec
+        if not fields in groups:
+            groups[fields] = ([], [])
+        groups[fields][0].append(i)
+        groups[fields][1].append(row)
+
+    # flatten each group into columns
+    if colnames is None:
+        colnames = OrderedDict()
+    flattened = []
+    for fields, (positions, rows) in groups.iteritems():
+        names, columns = flatten_rows(fields, rows, unwrap_tuples)
+        for k in names:
             if not k in colnames:
-                colnames.append(k)
-                      
-    # write it out
-    with open(csv_file, 'wb') as fout:
-        # create file and write header
-        dw = csv.DictWriter(fout, fieldnames=colnames)
-        dw.writeheader()
-        # continue on to write data
-        dw.writerows(dl)
+                colnames[k] = len(colnames)
+        flattened.append((positions, names, columns))
+
+    # put the rows back together in order
+    out = [None]*len(records)
+    for positions, names, columns in flattened:
+        order = dict(zip(names, columns))
+        empty = [None]*len(positions)
+        rows = zip(*[order.get(k, empty) for k in colnames])
+        for pos, row in zip(positions, rows):
+            out[pos] = row
+    return colnames.keys(), out
+
+def _row_batches(records, batch_size, unwrap_tuples=True, **append_cols):
+    # flatten records in batches for _write_csv
+    colnames = OrderedDict()
+    if append_cols:
+        # add the extra columns to the (fields, row) records
+        extra_fields = tuple(append_cols.keys())
+        extra = tuple(append_cols.values())
+        all_fields = {}
+    batch = []
+    for rec in records:
+        if append_cols:
+            fields, row = rec
+            if not fields in all_fields:
+                all_fields[fields] = fields + extra_fields
+            rec = (all_fields[fields], row + extra)
+        batch.append(rec)
+        if len(batch) >= batch_size:
+            yield flatten_records(batch, unwrap_tuples, colnames)
+            batch = []
+    if batch:
+        yield flatten_records(batch, unwrap_tuples, colnames)
+
+def _dict_batches(dictlist):
+    # one batch per dict
+    for d in dictlist:
+        yield d.keys(), [d.values()]
+
+def yaml2csv(dictlist, csv_file, batch_size=1000, strict=True, 
+             **append_cols):
+    """
+    Write a list (or any iterable) of dicts to a csv file in a single
+    pass. If passed the name of a yaml log it will be streamed in and
+    unwrapped in batches (see `flatten_records`).
+
+    Columns are added in the order they are first seen. Rows are
+    written as they come in and if new columns show up partway through
+    the file is re-stitched at the end with the full header. Records
+    of a yaml log that can't be parsed are skipped if strict is False
+    (see `iter_yaml`).
+
+    Returns the number of rows written.
+    """
+    # see if dictlist is a yaml file
+    if isinstance(dictlist,str):
+        # assume it's a file and stream it in
+        # get the unwraped batches
+        batches = _row_batches(iter_yaml(dictlist, batch_size=batch_size, 
+                                         strict=strict, **append_cols),
+                               batch_size)
+    else:
+        batches = _dict_batches(dictlist)
+    return _write_csv(batches, csv_file)
+
+def _write_csv(batches, csv_file):
+    # write (colnames, rows) batches to a csv file
+    # the column names as an ordered set
+    colnames = OrderedDict()
+    ncols_written = None
+    nrows = 0
+    fout = None
+    try:
+        for names, rows in batches:
+            # add any new columns
+            for k in names:
+                if not k in colnames:
+                    colnames[k] = len(colnames)
+            if fout is None:
+                # create file and write header
+                fout = open(csv_file, 'wb')
+                writer = csv.writer(fout)
+                writer.writerow(colnames.keys())
+                ncols_written = len(colnames)
+            # continue on to write data
+            inds = [colnames[k] for k in names]
+            if inds == range(len(inds)):
+                # already in order
+                writer.writerows(rows)
+            else:
+                ncols = len(colnames)
+                for row in rows:
+                    out = [None]*ncols
+                    for j, v in zip(inds, row):
+                        out[j] = v
+                    writer.writerow(out)
+            nrows += len(rows)
+    finally:
+        if not fout is None:
+            fout.close()
+
+    if fout is None or len(colnames) == ncols_written:
+        # nothing written or header is complete
+        return nrows
 
+    # late columns appeared, so re-stitch with the full header
+    ncols = len(colnames)
+    csv_dir = os.path.dirname(os.path.abspath(csv_file))
+    with open(csv_file, 'rb') as fin:
+        reader = csv.reader(fin)
+        reader.next()
+        with tempfile.NamedTemporaryFile(mode='wb', dir=csv_dir, 
+                                         suffix='.csv', delete=False) as ftmp:
+            writer = csv.writer(ftmp)
+            writer.writerow(colnames.keys())
+            for row in reader:
+                if len(row) < ncols:
+                    row.extend(['']*(ncols-len(row)))
+                writer.writerow(row)
+    if os.name == 'nt':
+        # can't rename over an existing file on windows
+        os.remove(csv_file)
+    os.rename(ftmp.name, csv_file)
+    return nrows
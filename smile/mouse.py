@@ -7,10 +7,13 @@
 #
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
+from utils import setup_pyglet
+setup_pyglet()
 from pyglet.window import mouse
 
 from state import State
-from ref import Ref, val
+from scheduler import wake_at
+from ref import Ref, val, invalidate
 
 # get the last instance of the experiment class
 from experiment import Experiment, now
@@ -129,15 +132,21 @@ class MousePress(State):
             if self.pressed in correct_resp:
                 self.correct = True
 
+            # drop the cached values of Refs that read the response
+            invalidate(self)
+
             # let's leave b/c we're all done
             #self.interval = 0
             self.leave()
             
     def _callback(self, dt):
+        wait_duration = val(self.wait_duration)
         if not self.waiting:
             self.exp.window.mouse_callbacks.append(self._mouse_callback)
             self.waiting = True
-        wait_duration = val(self.wait_duration)
+            if wait_duration > 0:
+                # make sure there's a tick at the timeout
+                wake_at(self.state_time+wait_duration)
         if ((wait_duration > 0 and now() >= self.state_time+wait_duration) or
             (val(self.wait_until))):
             # we're done
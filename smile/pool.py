@@ -0,0 +1,252 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import pyglet
+
+# where released labels and vertex lists are parked, well off the screen
+_PARK = -100000
+
+# label properties that can be changed after it is made (the group and
+# dpi can not, so they pick the free list)
+LABEL_PROPS = ('text', 'font_name', 'font_size', 'bold', 'italic', 'color',
+               'x', 'y', 'width', 'height', 'anchor_x', 'anchor_y',
+               'halign', 'multiline')
+
+# attribute of a vertex list for each format letter
+_VLIST_ATTRS = {'v':'vertices', 'c':'colors', 't':'tex_coords',
+                'n':'normals', 'e':'edge_flags', 's':'secondary_colors',
+                'f':'fog_coords'}
+
+def _fix_label_props(props):
+    # labels keep their color as a tuple
+    if isinstance(props.get('color'), list):
+        props['color'] = tuple(props['color'])
+
+def _get_label_prop(label, name):
+    if name == 'halign':
+        return label.document.get_style('halign')
+    return getattr(label, name)
+
+def _set_label_prop(label, name, value):
+    if name == 'halign':
+        label.set_style('halign', value)
+    else:
+        setattr(label, name, value)
+
+
+class ShownPool(object):
+    """
+    Recycle the labels, sprites, and vertex lists shown by the visual
+    states, so showing a stimulus on every trial of a Loop does not
+    make (and lay out) a new one every time.
+
+    Released items are hidden and kept on a free list. When an item is
+    needed again, a free one is patched with only the properties that
+    differ, so showing the same text again does not even need a new
+    layout. Items that were not made by the pool are simply deleted
+    when released.
+
+    Parameters
+    ----------
+    batch : Batch
+        Graphics batch to add the items to.
+    max_free : int
+        Most free items to keep of each kind, the rest are deleted.
+
+    Example
+    -------
+    label = pool.label(text='+', x=400, y=300, anchor_x='center')
+    ...
+    pool.release(label)
+    """
+    def __init__(self, batch, max_free=16):
+        self.batch = batch
+        self.max_free = max_free
+
+        # free lists keyed by the properties that can't be patched
+        self._free = {}
+
+        # key of every item we made, and the owner of those in use
+        self._keys = {}
+        self._in_use = {}
+
+    def _take(self, key, score=None, owner=None, reuse=None):
+        # pop the best matching free item (the most recent by default)
+        free = self._free.get(key)
+        if not free:
+            return None
+        ind = len(free)-1
+        if not reuse is None and reuse in free:
+            # the owner wants its old one back
+            ind = free.index(reuse)
+        elif not score is None:
+            best = None
+            for i in xrange(len(free)-1, -1, -1):
+                s = score(free[i])
+                if best is None or s < best:
+                    ind, best = i, s
+                    if s == 0:
+                        break
+        item = free.pop(ind)
+        self._in_use[item] = owner
+        return item
+
+    def _add(self, key, item, owner=None):
+        self._keys[item] = key
+        self._in_use[item] = owner
+        return item
+
+    def in_use(self, item, owner=None):
+        """
+        Whether the item was made by the pool and has not been
+        released (by the specified owner, if any).
+        """
+        if not item in self._in_use:
+            return False
+        return owner is None or self._in_use[item] is owner
+
+    def label(self, group=None, dpi=None, owner=None, reuse=None,
+              visible=True, **props):
+        """
+        Get a pyglet Label with the specified properties (see
+        LABEL_PROPS). An owner can ask to reuse the label it had
+        before, if it is still free. A label that is not visible is
+        laid out off the screen, so it only has to be moved to show it.
+        """
+        _fix_label_props(props)
+        if not visible:
+            props['x'] = _PARK
+        key = ('label', group, dpi)
+        label = self._take(key, lambda l: self._label_diff(l, props),
+                           owner=owner, reuse=reuse)
+        if label is None:
+            return self._add(key, pyglet.text.Label(dpi=dpi, group=group,
+                                                    batch=self.batch,
+                                                    **props),
+                             owner=owner)
+        self.patch_label(label, props)
+        return label
+
+    def _label_diff(self, label, props):
+        # number of properties that would need a new layout
+        return len([k for k, v in props.iteritems()
+                    if not k in ('x', 'y') and
+                    _get_label_prop(label, k) != v])
+
+    def patch_label(self, label, props):
+        """
+        Set the properties of a label that differ from the ones in the
+        props dict. Moving it only shifts its vertices, anything else
+        is done in a single new layout.
+        """
+        _fix_label_props(props)
+        changed = [(k, v) for k, v in props.iteritems()
+                   if not k in ('x', 'y') and
+                   _get_label_prop(label, k) != v]
+        if changed:
+            label.begin_update()
+            for k, v in changed:
+                _set_label_prop(label, k, v)
+        if 'x' in props and label.x != props['x']:
+            label.x = props['x']
+        if 'y' in props and label.y != props['y']:
+            label.y = props['y']
+        if changed:
+            label.end_update()
+
+    def sprite(self, img, x=0, y=0, group=None, scale=1.0, rotation=0,
+               opacity=255, visible=True):
+        """
+        Get a pyglet Sprite showing an image.
+        """
+        key = ('sprite', group)
+        sprite = self._take(key, lambda s: int(s.image is not img))
+        if sprite is None:
+            sprite = self._add(key, pyglet.sprite.Sprite(img, x=x, y=y,
+                                                         group=group,
+                                                         batch=self.batch))
+        self.patch_sprite(sprite, img, x=x, y=y, scale=scale,
+                          rotation=rotation, opacity=opacity,
+                          visible=visible)
+        return sprite
+
+    def patch_sprite(self, sprite, img, x=0, y=0, scale=1.0, rotation=0,
+                     opacity=255, visible=True):
+        """
+        Set the properties of a sprite that differ from the ones
+        specified.
+        """
+        if sprite.image is not img:
+            sprite.image = img
+        if sprite.scale != scale:
+            sprite.scale = scale
+        if sprite.rotation != rotation:
+            sprite.rotation = rotation
+        if sprite.opacity != opacity:
+            sprite.opacity = opacity
+        if sprite.position != (x, y):
+            sprite.set_position(x, y)
+        if sprite.visible != visible:
+            sprite.visible = visible
+
+    def vertex_list(self, count, mode, group, *data):
+        """
+        Get a vertex list, like Batch.add, with the same count, mode,
+        and group.
+        """
+        key = ('vlist', count, mode, group,
+               tuple([fmt for fmt, values in data]))
+        vlist = self._take(key)
+        if vlist is None:
+            return self._add(key, self.batch.add(count, mode, group, *data))
+        for fmt, values in data:
+            getattr(vlist, _VLIST_ATTRS[fmt[0]])[:] = values
+        return vlist
+
+    def release(self, item):
+        """
+        Hide an item so it can be used again (or delete it if it was
+        not made by the pool). Releasing it again does nothing.
+        """
+        key = self._keys.get(item)
+        if key is None:
+            # not one of ours
+            item.delete()
+            return
+        if not item in self._in_use:
+            # already free
+            return
+        del self._in_use[item]
+
+        free = self._free.setdefault(key, [])
+        if len(free) >= self.max_free:
+            # don't hold on to too many
+            del self._keys[item]
+            item.delete()
+            return
+
+        # hide it
+        if key[0] == 'label':
+            # keeps the layout, so the same text can be shown again
+            item.x = _PARK
+        elif key[0] == 'sprite':
+            item.visible = False
+        else:
+            item.vertices[:] = [_PARK]*len(item.vertices)
+        free.append(item)
+
+    def clear(self):
+        """
+        Delete all the free items.
+        """
+        for key, free in self._free.iteritems():
+            for item in free:
+                del self._keys[item]
+                item.delete()
+        self._free = {}
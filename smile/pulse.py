@@ -8,7 +8,6 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
 import sys
-from pyglet import clock
 try:
     import parallel
     have_parallel = True
@@ -19,6 +18,7 @@ except ImportError:
 
 
 from state import State
+from scheduler import schedule_once
 from ref import Ref, val
 from experiment import now,event_time
 
@@ -110,7 +110,7 @@ class Pulse(State):
                                          time_err)
 
             # schedule the off time
-            clock.schedule_once(self._pulse_off_callback, val(self.pulse_duration))
+            schedule_once(self._pulse_off_callback, val(self.pulse_duration))
 
     def _pulse_off_callback(self, dt):
         # turn off the code
@@ -0,0 +1,45 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+"""
+Salvage the complete records from logs damaged by a crash.
+
+Usage:
+
+    python -m smile.recover log_file [log_file ...] [-o OUT_FILE]
+
+Each log is written back out next to the original with .recovered
+before the extension (e.g., state.recovered.yaml), leaving the
+original untouched.
+"""
+
+import sys
+import argparse
+
+from log import recover_log
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recover damaged SMILE logs.')
+    parser.add_argument("log_files", nargs='+', 
+                        help="yaml or binary logs to recover")
+    parser.add_argument("-o", "--out_file", 
+                        help="where to write the recovered log (only with a single log)", 
+                        default=None)
+    args = parser.parse_args(argv)
+    if args.out_file and len(args.log_files) > 1:
+        parser.error("--out_file only works with a single log")
+
+    for log_file in args.log_files:
+        nrecs = recover_log(log_file, args.out_file)
+        print "%s: recovered %d records" % (log_file, nrecs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,6 +8,80 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
 import inspect
+import operator
+
+# number of evaluations before a Ref is compiled (None to never compile)
+COMPILE_AFTER = 2
+
+def _getattribute(obj, attr):
+    # module level (unlike object.__getattribute__) so it can be pickled
+    return object.__getattribute__(obj, attr)
+
+# per-tick cache of Ref evaluations (see enable_cache)
+_cache_enabled = False
+_generation = 0
+
+# cached Refs to throw out when an object they read changes, as
+# {id(obj): (obj, {id(ref): ref})}, filled in as they are cached
+_watchers = {}
+_watch_epoch = 0
+
+def enable_cache(enabled=True):
+    """
+    Turn the evaluation cache on or off.
+
+    With the cache on, a Ref made up of operators, lookups, and pure
+    functions (see `pure`) is only evaluated once until the cache is
+    invalidated. The Experiment invalidates the whole cache every tick
+    of its loop and whenever a value is set (e.g., by Set or a Loop
+    moving to its next item). When a state changes its own attributes
+    only the Refs that read that state are invalidated.
+    """
+    global _cache_enabled, _watch_epoch
+    _cache_enabled = enabled
+    _watchers.clear()
+    _watch_epoch += 1
+    invalidate()
+
+def invalidate(obj=None):
+    """
+    Throw out cached Ref values. Call this after changing anything a
+    Ref might read.
+
+    Parameters
+    ----------
+    obj : object, optional
+        Only throw out the values of the Refs that read this object
+        (see `dependencies`), such as a state that changed its own
+        attributes.
+    """
+    global _generation
+    if obj is None:
+        _generation += 1
+        return
+    watched = _watchers.get(id(obj))
+    if not watched is None:
+        for ref in watched[1].itervalues():
+            ref._cache_gen = -1
+
+# profiler timing every evaluation (see refprof.RefProfiler)
+_profiler = None
+
+def set_profiler(profiler):
+    """
+    Send every Ref evaluation through a profiler (or stop if None).
+    """
+    global _profiler
+    _profiler = profiler
+
+def pure(func):
+    """
+    Mark a function as only depending on its arguments (and values
+    that are invalidated when they change), so Refs that call it can
+    be cached. Returns the function, so it can be used as a decorator.
+    """
+    _pure_funcs.add(func)
+    return func
 
 class Ref(object):
     """
@@ -43,8 +117,34 @@ class Ref(object):
     str_sum = Ref(str)(x+y)
     ss = val(str_sum) # should be '40'
     print type(ss),ss
+
+    Refs can be pickled (operations are stored by their op code), so
+    an experiment built from them can be saved and loaded again.
+
+    Once a Ref has been evaluated COMPILE_AFTER times its whole
+    expression tree is compiled into a single function (see
+    `compile_ref`), which is used for every evaluation after that.
+
+    The objects and attributes a Ref reads are available from
+    `dependencies`. With the cache on (see `enable_cache`), a Ref made
+    up of operators on attributes that hold numbers or strings is
+    only recomputed when one of those values changes.
     
     """
+    # defined on the class so they don't go through __getattr__
+    _compiled = None
+    _nevals = 0
+    _cacheable = None
+    _cache_gen = -1
+    _cache_value = None
+    _cache_hits = 0
+    _watch_epoch = -1
+    _shared = False
+    _leaves = None
+    _memo_key = None
+    _memo_value = None
+    _plain_args = None
+
     def __init__(self, obj=None, attr=None, 
                  gfunc=None, gfunc_args=None, gfunc_kwargs=None):
         self.gfunc = gfunc
@@ -52,6 +152,8 @@ class Ref(object):
         self.gfunc_kwargs = gfunc_kwargs
         self.obj = obj
         self.attr = attr
+        self._compiled = None
+        self._nevals = 0
         # if self.gfunc is None:
         #     # try and define it based on the obj and attr
         #     if not obj is None and not attr is None:
@@ -70,6 +172,7 @@ class Ref(object):
             else:
                 # access with getitem
                 self.obj[self.attr] = value
+            invalidate()
         else:
             raise ValueError('You can only set a reference with a known obj and attr')
                 
@@ -85,15 +188,158 @@ class Ref(object):
         return Ref(gfunc=gfunc, gfunc_args=args, gfunc_kwargs=kwargs)
 
     def eval(self):
+        if not _profiler is None:
+            return _profiler.call(self)
+        if _cache_enabled and self.cacheable():
+            return self._eval_cached(self._eval_incremental)
+        return self._eval_compiled()
+
+    def _eval_cached(self, evaluate):
+        # the cached value if it's still good, otherwise the value
+        # from evaluate, which is cached
+        if self._cache_gen == _generation:
+            self._cache_hits += 1
+            return self._cache_value
+        gen = _generation
+        if self._watch_epoch != _watch_epoch:
+            self._watch()
+        value = evaluate()
+        self._cache_value = value
+        self._cache_gen = gen
+        return value
+
+    def _watch(self):
+        # have invalidating any object it reads throw out its value
+        for obj, attr in dependencies(self):
+            watched = _watchers.get(id(obj))
+            if watched is None:
+                watched = _watchers[id(obj)] = (obj, {})
+            watched[1][id(self)] = self
+        self._watch_epoch = _watch_epoch
+
+    def cacheable(self):
+        """
+        Whether the Ref only uses operators, lookups, and pure
+        functions, so its value can be cached (see `enable_cache`).
+        """
+        if self._cacheable is None:
+            self._cacheable = _is_pure(self)
+        return self._cacheable
+
+    @property
+    def op(self):
+        """
+        The op code (see OPS) of the operation this Ref performs, or
+        None if it is a lookup or calls some other function.
+        """
+        try:
+            return _op_codes.get(self.gfunc)
+        except TypeError:
+            # unhashable
+            return None
+
+    def __getstate__(self):
+        # store the operation by op code and leave out the caches and
+        # compiled code, which get rebuilt as it's used
+        state = {'obj':self.obj, 'attr':self.attr,
+                 'gfunc_args':self.gfunc_args, 
+                 'gfunc_kwargs':self.gfunc_kwargs}
+        op = self.op
+        if op is None:
+            state['gfunc'] = self.gfunc
+        else:
+            state['op'] = op
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        op = state.pop('op', None)
+        if not op is None:
+            state['gfunc'] = OPS[op]
+        self.__init__(**state)
+
+    def __repr__(self):
+        return '<Ref %s>' % describe(self)
+
+    def _reset(self):
+        # its children changed, so start over compiling and caching
+        self._compiled = None
+        self._nevals = 0
+        self._cacheable = None
+        self._cache_gen = -1
+        self._watch_epoch = -1
+        self._leaves = None
+        self._memo_key = None
+        self._plain_args = None
+
+    def dependencies(self):
+        """
+        Get the (obj, attr) pairs this Ref reads (see `dependencies`).
+        """
+        return dependencies(self)
+
+    def _eval_incremental(self):
+        # skip the evaluation if none of the values it reads changed
+        if self._leaves is None:
+            leaves = []
+            if _tracked_leaves(self, leaves) and leaves:
+                self._leaves = leaves
+            else:
+                self._leaves = False
+        if self._leaves:
+            key = []
+            for obj, attr in self._leaves:
+                value = _lookup(obj, attr)
+                if not type(value) in _scalar_set:
+                    # could change without us knowing
+                    return self._eval_compiled()
+                key.append((type(value), value))
+            if key == self._memo_key:
+                return self._memo_value
+            value = self._eval_compiled()
+            self._memo_key = key
+            self._memo_value = value
+            return value
+        return self._eval_compiled()
+
+    def _eval_compiled(self):
+        if self._compiled is None:
+            # see if it's time to compile
+            self._nevals += 1
+            if not COMPILE_AFTER is None and self._nevals >= COMPILE_AFTER:
+                try:
+                    self._compiled = compile_ref(self)
+                except Exception:
+                    # just keep interpreting it
+                    self._compiled = False
+        if self._compiled:
+            return self._compiled()
+        return self._eval()
+
+    def _eval(self):
+        if _is_op(self.gfunc, _lookup_funcs) and not self.gfunc_kwargs and \
+           isinstance(self.gfunc_args, tuple) and len(self.gfunc_args) == 2:
+            # look it up before evaluating the container's contents, so
+            # indexing a big list doesn't copy the whole thing
+            return self.gfunc(val(self.gfunc_args[0], recurse=False),
+                              val(self.gfunc_args[1]))
         if self.gfunc:
-            # eval the args to the func if necessary
+            # eval the args to the func if necessary (only looking
+            # for Refs in them the first time)
+            if self._plain_args is None:
+                self._plain_args = (_is_plain(self.gfunc_args),
+                                    _is_plain(self.gfunc_kwargs))
             if self.gfunc_args is None:
                 args = []
+            elif self._plain_args[0]:
+                args = self.gfunc_args
             else:
                 args = val(self.gfunc_args)
 
             if self.gfunc_kwargs is None:
                 kwargs = {}
+            elif self._plain_args[1]:
+                kwargs = self.gfunc_kwargs
             else:
                 kwargs = val(self.gfunc_kwargs)
             
@@ -102,8 +348,9 @@ class Ref(object):
         else:
             # try and define it based on the obj and attr
             if not self.obj is None:
-                # get the values of the obj and attr
-                obj = val(self.obj)
+                # get the values of the obj and attr (the attr or item
+                # is evaluated on its own, so no need to recurse)
+                obj = val(self.obj, recurse=self.attr is None)
             else:
                 raise ValueError("Ref must either have obj or gfunc defined.")
             if not self.attr is None:
@@ -119,74 +366,591 @@ class Ref(object):
         #return self.obj #getattr(self.obj, self.attr)
         
     def __getitem__(self, index):
-        return Ref(gfunc=lambda : val(self)[val(index)])
+        return Ref(gfunc=operator.getitem, gfunc_args=(self, index))
 
     #def __getattribute__(self, attr):
     def __getattr__(self, attr):
         #return Ref(gfunc=lambda : getattr(val(self),val(attr)))
-        return Ref(gfunc=lambda : object.__getattribute__(val(self), val(attr)))
+        if attr.startswith('__') and attr.endswith('__'):
+            # special methods (e.g., for pickling) are not references
+            raise AttributeError(attr)
+        return Ref(gfunc=_getattribute, gfunc_args=(self, attr))
         
     def __lt__(self, o):
-        return Ref(gfunc=lambda : val(self)<val(o))
+        return Ref(gfunc=operator.lt, gfunc_args=(self, o))
     def __le__(self, o):
-        return Ref(gfunc=lambda : val(self)<=val(o))
+        return Ref(gfunc=operator.le, gfunc_args=(self, o))
     def __gt__(self, o):
-        return Ref(gfunc=lambda : val(self)>val(o))
+        return Ref(gfunc=operator.gt, gfunc_args=(self, o))
     def __ge__(self, o):
-        return Ref(gfunc=lambda : val(self)>=val(o))
+        return Ref(gfunc=operator.ge, gfunc_args=(self, o))
     def __eq__(self, o):
-        return Ref(gfunc=lambda : val(self)==val(o))
+        return Ref(gfunc=operator.eq, gfunc_args=(self, o))
     def __ne__(self, o):
-        return Ref(gfunc=lambda : val(self)<>val(o))
+        return Ref(gfunc=operator.ne, gfunc_args=(self, o))
     def __and__(self, o):
-        return Ref(gfunc=lambda : val(self)&val(o))
+        return Ref(gfunc=operator.and_, gfunc_args=(self, o))
     def __rand__(self, o):
-        return Ref(gfunc=lambda : val(o)&val(self))
+        return Ref(gfunc=operator.and_, gfunc_args=(o, self))
     def __or__(self, o):
-        return Ref(gfunc=lambda : val(self)|val(o))
+        return Ref(gfunc=operator.or_, gfunc_args=(self, o))
     def __ror__(self, o):
-        return Ref(gfunc=lambda : val(o)|val(self))
+        return Ref(gfunc=operator.or_, gfunc_args=(o, self))
     def __xor__(self, o):
-        return Ref(gfunc=lambda : val(self)^val(o))
+        return Ref(gfunc=operator.xor, gfunc_args=(self, o))
     def __rxor__(self, o):
-        return Ref(gfunc=lambda : val(o)^val(self))
+        return Ref(gfunc=operator.xor, gfunc_args=(o, self))
     def __add__(self, o):
-        return Ref(gfunc=lambda : val(self)+val(o))
+        return Ref(gfunc=operator.add, gfunc_args=(self, o))
     def __radd__(self, o):
-        return Ref(gfunc=lambda : val(o)+val(self))
+        return Ref(gfunc=operator.add, gfunc_args=(o, self))
     def __sub__(self, o):
-        return Ref(gfunc=lambda : val(self)-val(o))
+        return Ref(gfunc=operator.sub, gfunc_args=(self, o))
     def __rsub__(self, o):
-        return Ref(gfunc=lambda : val(o)-val(self))
+        return Ref(gfunc=operator.sub, gfunc_args=(o, self))
     def __pow__(self, o):
-        return Ref(gfunc=lambda : val(self)**val(o))
+        return Ref(gfunc=operator.pow, gfunc_args=(self, o))
     def __rpow__(self, o):
-        return Ref(gfunc=lambda : val(o)**val(self))
+        return Ref(gfunc=operator.pow, gfunc_args=(o, self))
     def __mul__(self, o):
-        return Ref(gfunc=lambda : val(self)*val(o))
+        return Ref(gfunc=operator.mul, gfunc_args=(self, o))
     def __rmul__(self, o):
-        return Ref(gfunc=lambda : val(o)*val(self))
+        return Ref(gfunc=operator.mul, gfunc_args=(o, self))
     def __div__(self, o):
-        return Ref(gfunc=lambda : val(self)/val(o))
+        return Ref(gfunc=operator.div, gfunc_args=(self, o))
     def __floordiv__(self, o):
-        return Ref(gfunc=lambda : val(self)//val(o))
+        return Ref(gfunc=operator.floordiv, gfunc_args=(self, o))
     def __rdiv__(self, o):
-        return Ref(gfunc=lambda : val(o)/val(self))
+        return Ref(gfunc=operator.div, gfunc_args=(o, self))
     def __rfloordiv__(self, o):
-        return Ref(gfunc=lambda : val(o)//val(self))
+        return Ref(gfunc=operator.floordiv, gfunc_args=(o, self))
     def __mod__(self, o):
-        return Ref(gfunc=lambda : val(self)%val(o))
+        return Ref(gfunc=operator.mod, gfunc_args=(self, o))
     def __rmod__(self, o):
-        return Ref(gfunc=lambda : val(o)%val(self))
+        return Ref(gfunc=operator.mod, gfunc_args=(o, self))
     def __pos__(self):
         return self
     def __neg__(self):
-        return Ref(gfunc=lambda : -val(self))
+        return Ref(gfunc=operator.neg, gfunc_args=(self,))
     def append(self,o):
-        return Ref(gfunc=lambda : val(self)+[val(o)])
+        return Ref(gfunc=operator.add, gfunc_args=(self, [o]))
     def __contains__(self, key):
-        return Ref(gfunc=lambda : key in val(self))
+        return Ref(gfunc=operator.contains, gfunc_args=(self, key))
+
+
+# operators that are compiled inline, they give back plain values
+_binary_ops = {operator.lt:'<', operator.le:'<=', operator.gt:'>', 
+               operator.ge:'>=', operator.eq:'==', operator.ne:'!=',
+               operator.and_:'&', operator.or_:'|', operator.xor:'^',
+               operator.add:'+', operator.sub:'-', operator.pow:'**',
+               operator.mul:'*', operator.div:'/', 
+               operator.floordiv:'//', operator.mod:'%'}
+_unary_ops = {operator.neg:'-'}
+
+# op codes for the operations Refs are built from, so they are stored
+# by name when pickled
+OPS = {'lt':operator.lt, 'le':operator.le, 'gt':operator.gt, 
+       'ge':operator.ge, 'eq':operator.eq, 'ne':operator.ne,
+       'and':operator.and_, 'or':operator.or_, 'xor':operator.xor,
+       'add':operator.add, 'sub':operator.sub, 'pow':operator.pow,
+       'mul':operator.mul, 'div':operator.div, 
+       'floordiv':operator.floordiv, 'mod':operator.mod, 
+       'neg':operator.neg, 'getitem':operator.getitem, 
+       'contains':operator.contains, 'getattr':_getattribute}
+_op_codes = dict([(f, name) for name, f in OPS.iteritems()])
+
+# lookups that only need the container, not its evaluated contents
+_lookup_funcs = frozenset([operator.getitem, _getattribute])
+
+def _is_op(gfunc, ops):
+    # gfunc in ops, but functions that can't be hashed (e.g., the
+    # methods of a list, like lst.pop) are never in there
+    try:
+        return gfunc in ops
+    except TypeError:
+        return False
+
+# functions whose results can be cached
+_pure_funcs = set(_binary_ops.keys() + _unary_ops.keys() + 
+                  [operator.getitem, operator.contains, _getattribute])
+
+def is_pure(x):
+    """
+    Whether the Refs in x (a Ref, or a list, tuple, or dict holding
+    Refs) only use operators, lookups, and pure functions (see
+    `pure`), so evaluating them more than once changes nothing.
+    """
+    if isinstance(x, Ref):
+        return x.cacheable()
+    return _is_pure(x)
+
+def _is_pure(x):
+    # see if a Ref tree only calls pure functions
+    if isinstance(x, Ref):
+        if x.gfunc:
+            try:
+                if not x.gfunc in _pure_funcs:
+                    return False
+            except TypeError:
+                # unhashable
+                return False
+            return _is_pure(x.gfunc_args) and _is_pure(x.gfunc_kwargs)
+        return _is_pure(x.obj) and _is_pure(x.attr)
+    elif isinstance(x, (list, tuple)):
+        return all([_is_pure(v) for v in x])
+    elif isinstance(x, dict):
+        return all([_is_pure(v) for v in x.itervalues()])
+    return True
+
+# values that are safe to fold into the compiled code
+_scalar_types = (int, long, float, bool, str, unicode, type(None))
+_scalar_set = frozenset(_scalar_types)
+
+# functions that only depend on the values of their args
+_tracked_funcs = set(_binary_ops.keys() + _unary_ops.keys() + 
+                     [operator.getitem, operator.contains])
+
+def _lookup(obj, attr):
+    # same lookup as Ref.eval
+    if isinstance(attr, str) and hasattr(obj, attr):
+        return getattr(obj, attr)
+    return obj[attr]
+
+def _tracked_leaves(x, leaves):
+    # collect the (obj, attr) lookups at the leaves of a tree of
+    # operators, returning False if it does anything else
+    if isinstance(x, Ref):
+        if x.gfunc:
+            try:
+                if not x.gfunc in _tracked_funcs:
+                    return False
+            except TypeError:
+                return False
+            return _tracked_leaves(x.gfunc_args, leaves) and \
+                _tracked_leaves(x.gfunc_kwargs, leaves)
+        if isinstance(x.obj, Ref) or isinstance(x.attr, Ref):
+            # depends on a computed object or key
+            return False
+        if x.attr is None:
+            return isinstance(x.obj, _scalar_types)
+        leaves.append((x.obj, x.attr))
+        return True
+    elif type(x) is tuple:
+        return all([_tracked_leaves(v, leaves) for v in x])
+    # lists and dicts could be changed in place without us knowing
+    return isinstance(x, _scalar_types)
+
+def dependencies(x):
+    """
+    Find the objects and attributes read by the Refs in x.
+
+    Parameters
+    ----------
+    x : {Ref object, list, tuple, dict}
+        Ref, or container holding Refs, to search.
+
+    Returns a list of (obj, attr) pairs, where obj is an object (e.g.,
+    a state) given to a Ref and attr is the attribute or key looked up
+    on it. The attr is None when the whole object is read or the key
+    is itself computed. Lookups on computed values (e.g., the 'rt' in
+    Ref(Get('kp'), 'rt')) are not included, but the Refs that compute
+    them are.
+
+    Example
+    -------
+    kp = KeyPress()
+    cond = (kp['rt'] < .5) & kp['correct']
+    dependencies(cond) # [(kp, 'rt'), (kp, 'correct')]
+    """
+    deps = []
+    _find_deps(x, deps, set(), set())
+    return deps
+
+def _find_deps(x, deps, seen, found):
+    if isinstance(x, Ref):
+        if id(x) in seen:
+            return
+        seen.add(id(x))
+        if x.gfunc:
+            _find_deps(x.gfunc_args, deps, seen, found)
+            _find_deps(x.gfunc_kwargs, deps, seen, found)
+            return
+        if isinstance(x.obj, Ref):
+            _find_deps(x.obj, deps, seen, found)
+        elif not x.obj is None:
+            if isinstance(x.attr, Ref):
+                dep = (x.obj, None)
+            else:
+                dep = (x.obj, x.attr)
+            try:
+                key = (id(dep[0]), dep[1])
+                hash(key)
+            except TypeError:
+                key = (id(dep[0]), id(dep[1]))
+            if not key in found:
+                found.add(key)
+                deps.append(dep)
+        _find_deps(x.attr, deps, seen, found)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _find_deps(v, deps, seen, found)
+    elif isinstance(x, dict):
+        for v in x.itervalues():
+            _find_deps(v, deps, seen, found)
+
+# no value to fold
+_nofold = object()
+
+def describe(x):
+    """
+    Short description of a Ref node (its operation and constant
+    operands) or any other value, used to label Refs in reports.
+    """
+    if not isinstance(x, Ref):
+        if isinstance(x, _scalar_types):
+            return repr(x)
+        return type(x).__name__
+    args = x.gfunc_args
+    if not isinstance(args, (list, tuple)):
+        args = ()
+    operands = [describe(a) if not isinstance(a, Ref) else '*' 
+                for a in args]
+    if _is_op(x.gfunc, _binary_ops) and len(operands) == 2:
+        return '%s %s %s' % (operands[0], _binary_ops[x.gfunc], operands[1])
+    elif _is_op(x.gfunc, _unary_ops) and len(operands) == 1:
+        return '%s%s' % (_unary_ops[x.gfunc], operands[0])
+    elif x.gfunc is operator.getitem and len(operands) == 2:
+        return '%s[%s]' % tuple(operands)
+    elif x.gfunc is _getattribute and len(operands) == 2:
+        return '%s.%s' % (operands[0], args[1])
+    elif x.gfunc:
+        name = getattr(x.gfunc, '__name__', type(x.gfunc).__name__)
+        return '%s(%s)' % (name, ', '.join(operands))
+    obj = '*' if isinstance(x.obj, Ref) else describe(x.obj)
+    if x.attr is None:
+        return obj
+    elif isinstance(x.attr, str):
+        return '%s.%s' % (obj, x.attr)
+    return '%s[%s]' % (obj, '*' if isinstance(x.attr, Ref) 
+                       else describe(x.attr))
+
+class _NotCompilable(Exception):
+    pass
+
+class _RefCompiler(object):
+    # turn a Ref tree into the source of a single function, with each
+    # node evaluated into a temporary in the order val() would do it
+
+    def __init__(self, root=None):
+        self.root = root
+        self.lines = []
+        self.consts = {'_v':val}
+        self._const_names = {}
+        self._ntemps = 0
+
+    def const(self, value):
+        # name of a constant in the function's namespace
+        name = self._const_names.get(id(value))
+        if name is None:
+            name = '_c%d' % len(self._const_names)
+            self._const_names[id(value)] = name
+            self.consts[name] = value
+        return name
+
+    def temp(self, expr):
+        name = '_t%d' % self._ntemps
+        self._ntemps += 1
+        self.lines.append('%s = %s' % (name, expr))
+        return name
+
+    def emit_val(self, x):
+        # code for val(x), returns the expression and its folded value
+        if isinstance(x, Ref):
+            expr, folded, plain = self.emit_eval(x)
+            if plain:
+                return expr, folded
+            return self.temp('_v(%s)' % expr), _nofold
+        elif type(x) == tuple:
+            # tuples can't change, so evaluate the items in place
+            items = [self.emit_val(v)[0] for v in x]
+            return self.temp('(%s)' % ''.join([i+', ' for i in items])), \
+                _nofold
+        elif isinstance(x, (list, tuple, dict)):
+            # these could change, so leave them to val
+            return self.temp('_v(%s)' % self.const(x)), _nofold
+        elif isinstance(x, _scalar_types):
+            return self.const(x), x
+        else:
+            return self.const(x), _nofold
+
+    def emit_shallow(self, x):
+        # code for val(x, recurse=False)
+        if isinstance(x, Ref):
+            expr, folded, plain = self.emit_eval(x)
+            if plain:
+                return expr, folded
+            return self.temp('_v(%s, False)' % expr), _nofold
+        elif isinstance(x, _scalar_types):
+            return self.const(x), x
+        return self.const(x), _nofold
+
+    def emit_eval(self, ref):
+        # code for ref.eval(), returns the expression, its folded
+        # value, and whether it still needs to go through val
+        if ref._shared and not ref is self.root:
+            # other Refs use it, so let it evaluate (and cache) itself
+            return self.temp('%s.eval()' % self.const(ref)), _nofold, False
+        if ref.gfunc:
+            return self.emit_call(ref.gfunc, ref.gfunc_args, ref.gfunc_kwargs)
+        if ref.obj is None:
+            raise _NotCompilable("Ref must either have obj or gfunc defined.")
+        if ref.attr is None:
+            obj, folded = self.emit_val(ref.obj)
+            return obj, folded, True
+        obj, folded = self.emit_shallow(ref.obj)
+        attr, attr_folded = self.emit_val(ref.attr)
+        if attr_folded is _nofold or isinstance(attr_folded, str):
+            # attribute if it has one, otherwise an item
+            cond = 'hasattr(%s, %s)' % (obj, attr)
+            if attr_folded is _nofold:
+                cond = 'isinstance(%s, str) and %s' % (attr, cond)
+            t = '_t%d' % self._ntemps
+            self._ntemps += 1
+            self.lines.extend(['if %s:' % cond,
+                               '    %s = getattr(%s, %s)' % (t, obj, attr),
+                               'else:',
+                               '    %s = %s[%s]' % (t, obj, attr)])
+            return t, _nofold, False
+        return self.temp('%s[%s]' % (obj, attr)), _nofold, False
+
+    def emit_call(self, gfunc, args, kwargs):
+        if args is None:
+            args = ()
+        if kwargs is None:
+            kwargs = {}
+        if not isinstance(args, (list, tuple)) or \
+           not isinstance(kwargs, dict):
+            raise _NotCompilable("The gfunc_args must be a list or tuple.")
+        if not kwargs and len(args) == 2 and _is_op(gfunc, _lookup_funcs):
+            # look up the item or attribute before evaluating the rest
+            # of the container
+            obj = self.emit_shallow(args[0])[0]
+            index = self.emit_val(args[1])[0]
+            if gfunc is operator.getitem:
+                return self.temp('%s[%s]' % (obj, index)), _nofold, False
+            return self.temp('%s(%s, %s)' % (self.const(gfunc), obj, index)), \
+                _nofold, False
+        args = [self.emit_val(a) for a in args]
+        kwargs = [(self.const(k), self.emit_val(v)[0]) 
+                  for k, v in kwargs.iteritems()]
+        if not kwargs and len(args) == 2 and _is_op(gfunc, _binary_ops):
+            folded = self.fold(gfunc, args)
+            if not folded is _nofold:
+                return self.const(folded), folded, True
+            return self.temp('%s %s %s' % (args[0][0], _binary_ops[gfunc], 
+                                           args[1][0])), _nofold, True
+        if not kwargs and len(args) == 1 and _is_op(gfunc, _unary_ops):
+            folded = self.fold(gfunc, args)
+            if not folded is _nofold:
+                return self.const(folded), folded, True
+            return self.temp('%s%s' % (_unary_ops[gfunc], args[0][0])), \
+                _nofold, True
+        if not kwargs and len(args) == 2 and gfunc is operator.contains:
+            return self.temp('%s in %s' % (args[1][0], args[0][0])), \
+                _nofold, True
+        params = [a[0] for a in args]
+        if kwargs:
+            params.append('**{%s}' % ', '.join(['%s: %s' % kv 
+                                                for kv in kwargs]))
+        return self.temp('%s(%s)' % (self.const(gfunc), ', '.join(params))), \
+            _nofold, False
+
+    def fold(self, gfunc, args):
+        # work it out now if all the args are constants
+        if [a for a in args if a[1] is _nofold]:
+            return _nofold
+        try:
+            value = gfunc(*[a[1] for a in args])
+        except Exception:
+            # leave the error for when it's evaluated
+            return _nofold
+        if not isinstance(value, _scalar_types):
+            return _nofold
+        return value
+
+def compile_ref(ref):
+    """
+    Compile a Ref's expression tree into a single function.
+
+    The tree is walked once and each node becomes a line of generated
+    source, so evaluating it does not go through a chain of eval and
+    val calls. Operators are written inline and operations on
+    constants are folded in. Calling the function is the same as
+    calling ref.eval(), and its source is in the function's source
+    attribute. Refs shared with other trees (see `RefSharer`) are
+    called rather than compiled in, so with the cache on they can use
+    their cached value.
+    """
+    compiler = _RefCompiler(ref)
+    expr, folded, plain = compiler.emit_eval(ref)
+    source = 'def _ref_eval():\n' + \
+        ''.join(['    %s\n' % line for line in compiler.lines]) + \
+        '    return %s\n' % expr
+    namespace = compiler.consts
+    exec compile(source, '<ref>', 'exec', 0, True) in namespace
+    func = namespace['_ref_eval']
+    func.source = source
+    return func
+
         
+class RefSharer(object):
+    """
+    Merge structurally identical Ref subtrees (hash-consing).
+
+    Experiments often build the same expression in several places,
+    such as trial.current['stim'] used by a Text, a KeyPress, and a
+    Log. Passing every value that might hold Refs through `share`
+    swaps each repeated subtree for a single shared Ref, so with the
+    cache on (see `enable_cache`) its value is reused by every use
+    until something it reads is invalidated, instead of being worked
+    out again for each one. Only subtrees that can be cached are
+    merged. Lists and dicts are updated in place.
+
+    Example
+    -------
+    sharer = RefSharer()
+    for state in states:
+        for name, value in state.__dict__.items():
+            setattr(state, name, sharer.share(value))
+    ...
+    print sharer.merged, sharer.saved()
+    """
+    def __init__(self):
+        self.merged = 0
+        self._nodes = {}
+        self._done = {}
+        self._uses = {}
+        self._refs = []
+        self._keep = []
+
+    def share(self, x):
+        """
+        Return x with its Refs replaced by the shared ones.
+        """
+        return self._share(x)[1]
+
+    def shared(self):
+        """
+        The Refs that are used in more than one place.
+        """
+        return [r for r in self._refs if r._shared]
+
+    def saved(self):
+        """
+        Number of times a shared Ref's value came from the cache
+        instead of being evaluated, so far.
+        """
+        return sum([r._cache_hits for r in self.shared()])
+
+    def _share(self, x):
+        # returns the structural key and new value of x
+        if isinstance(x, Ref):
+            ref, key = self._share_ref(x)
+            uses = self._uses.get(id(ref), 0) + 1
+            self._uses[id(ref)] = uses
+            if uses > 1:
+                ref._shared = True
+            return ('r', id(ref)), ref
+        elif type(x) is tuple:
+            keys, items = zip(*[self._share(v) for v in x]) or ((), ())
+            if [1 for a, b in zip(x, items) if not a is b]:
+                x = items
+            return ('t',) + keys, x
+        elif type(x) is list:
+            for i, v in enumerate(x):
+                new = self._share(v)[1]
+                if not new is v:
+                    x[i] = new
+        elif type(x) is dict:
+            for k, v in x.items():
+                new = self._share(v)[1]
+                if not new is v:
+                    x[k] = new
+        elif type(x) is float:
+            # repr tells 0.0 from -0.0
+            return (float, repr(x)), x
+        elif isinstance(x, _scalar_types):
+            return (type(x), x), x
+        # anything else is only the same as itself
+        return ('id', id(x)), x
+
+    def _share_ref(self, ref):
+        done = self._done.get(id(ref))
+        if not done is None:
+            return done
+
+        # share its children first, so they can be keyed by identity
+        if ref.gfunc:
+            args_key, args = self._share(ref.gfunc_args)
+            kwargs_key, kwargs = self._share(ref.gfunc_kwargs)
+            if not args is ref.gfunc_args:
+                ref.gfunc_args = args
+                ref._reset()
+            key = ('f', id(ref.gfunc), args_key, kwargs_key)
+        else:
+            obj_key, obj = self._share(ref.obj)
+            attr_key, attr = self._share(ref.attr)
+            if not obj is ref.obj or not attr is ref.attr:
+                ref.obj = obj
+                ref.attr = attr
+                ref._reset()
+            key = ('o', obj_key, attr_key)
+
+        canonical = ref
+        if ref.cacheable():
+            try:
+                canonical = self._nodes.setdefault(key, ref)
+            except TypeError:
+                # unhashable key
+                pass
+            if not canonical is ref:
+                self.merged += 1
+        if canonical is ref:
+            self._refs.append(ref)
+        # hold on to it so the id isn't reused
+        self._done[id(ref)] = (canonical, key)
+        self._keep.append(ref)
+        return canonical, key
+
+_container_types = frozenset([list, tuple, dict])
+
+def _has_refs(x):
+    # see if a list, tuple, or dict holds any Refs (or anything else
+    # val would have to rebuild), scanning the types of the items at
+    # C speed and only descending into the containers among them
+    if type(x) is dict:
+        items = x.values()
+    else:
+        items = x
+    types = set(map(type, items))
+    if types <= _scalar_set:
+        return False
+    for t in types:
+        if issubclass(t, (Ref, list, tuple, dict)) and \
+           not t in _container_types:
+            # a Ref or a subclass val would convert
+            return True
+    if types.isdisjoint(_container_types):
+        return False
+    for v in items:
+        if type(v) in _container_types and _has_refs(v):
+            return True
+    return False
+
+def _is_plain(x):
+    # whether val(x) would return x as is
+    return type(x) in _container_types and not _has_refs(x)
+
 def val(x, recurse=True):
     """
     Evaluate a Ref object.
@@ -195,7 +959,8 @@ def val(x, recurse=True):
 
     This method will (optionally) recursively evaluate lists and dictionaries 
     to ensure all Refs are evaluated. It is safe to call this on non-Ref objects,
-    and it will simply return what is passed in.
+    and it will simply return what is passed in. Lists, tuples, and dicts
+    that hold no Refs are returned as is instead of being copied.
     
     Parameters
     ----------
@@ -209,6 +974,9 @@ def val(x, recurse=True):
     while isinstance(x,Ref): #or inspect.isfunction(x) or inspect.isbuiltin(x):
         x = x.eval()
     if recurse:
+        if _is_plain(x):
+            # nothing to evaluate, so no need to copy it
+            return x
         if isinstance(x,list):
             # make sure we get value of all the items
             x = [val(x[i]) for i in xrange(len(x))]
@@ -219,6 +987,39 @@ def val(x, recurse=True):
             x = {k:val(x[k]) for k in x}        
     return x
 
+def snapshot(x):
+    """
+    Copy the lists and dicts in x, so changing them later does not
+    change the copy. Since val hands back containers without Refs as
+    they are, use this on values that are kept around (e.g., logged
+    or stored in an experiment variable).
+
+    Parameters
+    ----------
+    x : object
+        Value to copy. Anything other than a list, tuple, or dict is
+        returned as is.
+    """
+    t = type(x)
+    if not t in _container_types:
+        return x
+    if t is dict:
+        items = x.values()
+    else:
+        items = x
+    if set(map(type, items)) <= _scalar_set:
+        # nothing nested to copy
+        if t is list:
+            return x[:]
+        elif t is dict:
+            return x.copy()
+        return x
+    if t is list:
+        return [snapshot(v) for v in x]
+    elif t is tuple:
+        return tuple([snapshot(v) for v in x])
+    return dict([(k, snapshot(v)) for k, v in x.iteritems()])
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,146 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+from timeit import default_timer
+
+import ref
+
+class RefProfiler(object):
+    """
+    Time the evaluation of every Ref node.
+
+    While a profiler is running (see `start`) each Ref node records how
+    many times it was evaluated, its cumulative time (including the
+    Refs it evaluates), and its self time. Refs are interpreted rather
+    than compiled while profiling, so each node is timed on its own.
+    With the Ref cache on (see `ref.enable_cache`) the values read from
+    the cache are counted separately from the evaluations. Nodes can
+    be labeled with the state and attribute that
+    hold them with `add_owner`, which the Experiment does for every
+    state when run with --profile_refs.
+
+    Example
+    -------
+    prof = RefProfiler()
+    prof.start()
+    ...
+    prof.stop()
+    print prof.report()
+    prof.write_collapsed('refs.folded') # for flamegraph.pl
+    """
+    def __init__(self):
+        self.stats = {}
+        self.stacks = {}
+        self.owners = {}
+        self._stack = []
+
+    def start(self):
+        """
+        Start profiling all Ref evaluations.
+        """
+        ref.set_profiler(self)
+
+    def stop(self):
+        """
+        Stop profiling.
+        """
+        ref.set_profiler(None)
+
+    def add_owner(self, x, owner):
+        """
+        Label the Refs in x (a Ref or a container holding Refs) with the
+        name of what holds them (e.g., 'Text.text').
+        """
+        if isinstance(x, ref.Ref):
+            self.owners.setdefault(id(x), owner)
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                self.add_owner(v, owner)
+        elif isinstance(x, dict):
+            for v in x.itervalues():
+                self.add_owner(v, owner)
+
+    def call(self, r):
+        # evaluate a Ref, going through the cache if it's on
+        if ref._cache_enabled and r.cacheable():
+            hits = r._cache_hits
+            value = r._eval_cached(lambda: self._time(r))
+            if r._cache_hits > hits:
+                # read from the cache, so there was nothing to time
+                self._stats(r)[4] += 1
+            return value
+        return self._time(r)
+
+    def _stats(self, r):
+        # the [ref, calls, cumulative, self, cache reads] of a node
+        stats = self.stats.get(id(r))
+        if stats is None:
+            stats = [r, 0, 0.0, 0.0, 0]
+            self.stats[id(r)] = stats
+        return stats
+
+    def _time(self, r):
+        # evaluate a Ref, timing it and charging its time to its caller
+        frame = [r, 0.0]
+        self._stack.append(frame)
+        start = default_timer()
+        try:
+            return r._eval()
+        finally:
+            elapsed = default_timer() - start
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] += elapsed
+            self_time = elapsed - frame[1]
+
+            # add it to the node's stats
+            stats = self._stats(r)
+            stats[1] += 1
+            stats[2] += elapsed
+            stats[3] += self_time
+
+            # and to the stack it was called from
+            key = ';'.join([self._label(f[0]) for f in self._stack] + 
+                           [self._label(r)])
+            self.stacks[key] = self.stacks.get(key, 0.0) + self_time
+
+    def _label(self, r):
+        owner = self.owners.get(id(r))
+        if owner is None:
+            return ref.describe(r)
+        return '%s=%s' % (owner, ref.describe(r))
+
+    def report(self, limit=20, sort='cumulative'):
+        """
+        Return a table of the Ref nodes with the most time, sorted by
+        'cumulative' or 'self' time or by number of 'calls' or 'cached'
+        reads.
+        """
+        col = {'calls':1, 'cumulative':2, 'self':3, 'cached':4}[sort]
+        stats = sorted(self.stats.values(), key=lambda s: s[col], 
+                       reverse=True)
+        if not limit is None:
+            stats = stats[:limit]
+        lines = ['%10s %10s %12s %12s %12s  %s' % ('calls', 'cached',
+                                                   'cum (ms)', 'self (ms)',
+                                                   'per call (us)', 'ref')]
+        for r, ncalls, cum, self_time, ncached in stats:
+            lines.append('%10d %10d %12.3f %12.3f %12.3f  %s' % 
+                         (ncalls, ncached, cum*1000., self_time*1000., 
+                          cum/max(ncalls, 1)*1e6, self._label(r)))
+        return '\n'.join(lines)
+
+    def write_collapsed(self, filename):
+        """
+        Write the self time (in microseconds) of each call stack in the
+        collapsed format read by flamegraph.pl and speedscope.
+        """
+        with open(filename, 'w') as fout:
+            for key in sorted(self.stacks):
+                fout.write('%s %d\n' % (key, round(self.stacks[key]*1e6)))
@@ -0,0 +1,315 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import sys
+import time
+import heapq
+import itertools
+
+# same time source as the pyglet clock
+if sys.platform in ('win32', 'cygwin'):
+    _default_time = time.clock
+else:
+    _default_time = time.time
+
+class VirtualClock(object):
+    """
+    Clock that only moves when it is told to, so an experiment can be
+    simulated faster than real time (see `set_clock`).
+
+    Parameters
+    ----------
+    start : float
+        Starting time in seconds. Defaults to the current time, so the
+        logged times look like those of a real session.
+
+    Example
+    -------
+    vclock = VirtualClock()
+    set_clock(vclock)
+    vclock.advance(2.0)
+    """
+    def __init__(self, start=None):
+        if start is None:
+            start = _default_time()
+        self._time = start
+
+    def __call__(self):
+        return self._time
+
+    def advance(self, dt):
+        """
+        Move the clock ahead dt seconds.
+        """
+        if dt > 0:
+            self._time += dt
+
+    def advance_to(self, ts):
+        """
+        Move the clock ahead to time ts (it never goes back).
+        """
+        if ts > self._time:
+            self._time = ts
+
+
+class _ScheduledItem(object):
+    # a single scheduled callback
+    __slots__ = ('func', 'args', 'kwargs', 'interval', 'every_frame',
+                 'next_ts', 'last_ts', 'cancelled')
+
+    def __init__(self, func, args, kwargs, interval, every_frame,
+                 next_ts, last_ts):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval
+        self.every_frame = every_frame
+        self.next_ts = next_ts
+        self.last_ts = last_ts
+        self.cancelled = False
+
+    def call(self, ts):
+        dt = ts - self.last_ts
+        self.last_ts = ts
+        self.func(dt, *self.args, **self.kwargs)
+
+
+class Scheduler(object):
+    """
+    Priority queue of timed callbacks for the states.
+
+    Callbacks waiting for their time are kept in a heap, so scheduling
+    and finding the next due callback are O(log n). Unscheduling marks
+    the items as cancelled and they are dropped when they reach the
+    top of the heap (or the heap is compacted), so it only costs as
+    much as the number of items scheduled for that function. Like the
+    pyglet clock, each callback is passed the time in seconds since it
+    was scheduled or last called.
+
+    Parameters
+    ----------
+    time_func : function
+        Function returning the current time in seconds. Defaults to
+        the same time source used by the pyglet clock.
+
+    Example
+    -------
+    sched = Scheduler()
+    sched.schedule_delayed(func, 1.0)
+    while True:
+        sched.tick()
+    """
+    def __init__(self, time_func=None):
+        if time_func is None:
+            time_func = _default_time
+        self.time = time_func
+
+        # (next_ts, count, item) for items waiting on their time
+        self._heap = []
+        self._count = itertools.count()
+        self._ncancelled = 0
+
+        # items called on every tick
+        self._frame_items = []
+
+        # active items for each function, for unscheduling
+        self._items = {}
+
+        self.last_ts = None
+
+        # count of items added, removed, and called, so a simulation
+        # can tell whether a tick did anything
+        self.nops = 0
+
+    def set_clock(self, time_func):
+        """
+        Use a different function for the current time (e.g., a
+        VirtualClock). None goes back to the default.
+        """
+        if time_func is None:
+            time_func = _default_time
+        self.time = time_func
+        self.last_ts = None
+
+    def _add(self, func, args, kwargs, delay, interval, every_frame):
+        ts = self.time()
+        item = _ScheduledItem(func, args, kwargs, interval, every_frame,
+                              ts + delay, ts)
+        self._items.setdefault(func, []).append(item)
+        heapq.heappush(self._heap, (item.next_ts, next(self._count), item))
+        self.nops += 1
+        return item
+
+    def _remove(self, item):
+        # no longer active, so forget it for unscheduling
+        items = self._items.get(item.func)
+        if items is not None:
+            try:
+                items.remove(item)
+            except ValueError:
+                pass
+            if not items:
+                del self._items[item.func]
+
+    def schedule_once(self, func, delay, *args, **kwargs):
+        """
+        Schedule a function to be called once after delay seconds.
+        """
+        self._add(func, args, kwargs, delay, 0, False)
+
+    def schedule_delayed_interval(self, func, delay, interval,
+                                  *args, **kwargs):
+        """
+        Schedule a function to be called after delay seconds and then
+        every interval seconds (0 means once).
+        """
+        self._add(func, args, kwargs, delay, interval, False)
+
+    def schedule_delayed(self, func, delay, *args, **kwargs):
+        """
+        Schedule a function to be called on every tick starting after
+        delay seconds.
+        """
+        self._add(func, args, kwargs, delay, 0, True)
+
+    def wake_at(self, ts):
+        """
+        Make sure there is a tick at time ts. This is for states that
+        poll the time on every tick, so a simulation can jump ahead to
+        when they are done waiting.
+        """
+        self._add(_wakeup, (), {}, ts - self.time(), 0, False)
+
+    def schedule(self, func, *args, **kwargs):
+        """
+        Schedule a function to be called on every tick.
+        """
+        self.schedule_delayed(func, 0, *args, **kwargs)
+
+    def unschedule(self, func):
+        """
+        Remove all scheduled calls to a function (no error if there
+        are none).
+        """
+        items = self._items.pop(func, None)
+        if not items:
+            return
+        self.nops += 1
+        for item in items:
+            item.cancelled = True
+            if not item.every_frame or item.next_ts is not None:
+                # still in the heap
+                self._ncancelled += 1
+
+        # compact the heap if it's mostly cancelled items
+        if self._ncancelled > 32 and self._ncancelled*2 > len(self._heap):
+            self._heap = [e for e in self._heap if not e[2].cancelled]
+            heapq.heapify(self._heap)
+            self._ncancelled = 0
+
+    def next_time(self):
+        """
+        Time of the next timed callback, None if there is none.
+        """
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._ncancelled -= 1
+        if heap:
+            return heap[0][0]
+        return None
+
+    def tick(self):
+        """
+        Call the callbacks that are due and return the seconds since
+        the last tick.
+        """
+        ts = self.time()
+        if self.last_ts is None:
+            dt = 0
+        else:
+            dt = ts - self.last_ts
+        self.last_ts = ts
+
+        # the per-frame callbacks (new ones wait for the next tick)
+        if self._frame_items:
+            items = [item for item in self._frame_items
+                     if not item.cancelled]
+            self._frame_items = items
+            for item in items[:]:
+                if not item.cancelled:
+                    item.call(ts)
+
+        # the timed callbacks that were due when the tick started
+        heap = self._heap
+        last_count = next(self._count)
+        while heap and heap[0][0] <= ts and heap[0][1] < last_count:
+            next_ts, count, item = heapq.heappop(heap)
+            if item.cancelled:
+                self._ncancelled -= 1
+                continue
+            self.nops += 1
+            if item.every_frame:
+                # time to start calling it on every tick
+                item.next_ts = None
+                self._frame_items.append(item)
+            elif item.interval > 0:
+                # schedule the next call, skipping any we missed
+                item.next_ts += item.interval
+                if item.next_ts <= ts:
+                    item.next_ts = ts + item.interval
+                heapq.heappush(heap, (item.next_ts, next(self._count), item))
+            else:
+                self._remove(item)
+            item.call(ts)
+
+        return dt
+
+
+def _wakeup(dt):
+    # nothing to do, the tick is all that's needed
+    pass
+
+
+# the scheduler used by the states
+_default = Scheduler()
+
+def set_clock(time_func):
+    _default.set_clock(time_func)
+set_clock.__doc__ = Scheduler.set_clock.__doc__
+
+def wake_at(ts):
+    _default.wake_at(ts)
+wake_at.__doc__ = Scheduler.wake_at.__doc__
+
+def schedule_once(func, delay, *args, **kwargs):
+    _default.schedule_once(func, delay, *args, **kwargs)
+schedule_once.__doc__ = Scheduler.schedule_once.__doc__
+
+def schedule_delayed_interval(func, delay, interval, *args, **kwargs):
+    _default.schedule_delayed_interval(func, delay, interval,
+                                       *args, **kwargs)
+schedule_delayed_interval.__doc__ = \
+    Scheduler.schedule_delayed_interval.__doc__
+
+def schedule_delayed(func, delay, *args, **kwargs):
+    _default.schedule_delayed(func, delay, *args, **kwargs)
+schedule_delayed.__doc__ = Scheduler.schedule_delayed.__doc__
+
+def schedule(func, *args, **kwargs):
+    _default.schedule(func, *args, **kwargs)
+schedule.__doc__ = Scheduler.schedule.__doc__
+
+def unschedule(func):
+    _default.unschedule(func)
+unschedule.__doc__ = Scheduler.unschedule.__doc__
+
+def tick():
+    return _default.tick()
+tick.__doc__ = Scheduler.tick.__doc__
@@ -0,0 +1,247 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+import random
+
+from utils import setup_pyglet
+setup_pyglet()
+from pyglet.window import key, mouse
+
+from ref import val
+from state import now
+from scheduler import wake_at
+from pool import ShownPool
+
+class RandomResponder(object):
+    """
+    Make up responses for simulated KeyPress and MousePress states.
+
+    The response is correct with probability p_correct (when the state
+    has a correct response) and otherwise a random choice of the
+    allowed keys or buttons. The response time is drawn from a normal
+    distribution, but never shorter than min_rt.
+
+    Parameters
+    ----------
+    rt_mean : float
+        Mean response time in seconds.
+    rt_sd : float
+        Standard deviation of the response time in seconds.
+    min_rt : float
+        Shortest response time in seconds.
+    p_correct : float
+        Probability of making the correct response.
+    p_respond : float
+        Probability of responding at all.
+
+    Example
+    -------
+    exp.responder = RandomResponder(rt_mean=.8, p_correct=.9)
+    """
+    def __init__(self, rt_mean=.6, rt_sd=.15, min_rt=.15, p_correct=.8,
+                 p_respond=1.0):
+        self.rt_mean = rt_mean
+        self.rt_sd = rt_sd
+        self.min_rt = min_rt
+        self.p_correct = p_correct
+        self.p_respond = p_respond
+
+    def respond(self, state, choices, correct):
+        """
+        Return a (response, rt) tuple for a state waiting on one of
+        the choices, or None to not respond.
+        """
+        if random.random() >= self.p_respond:
+            return None
+        if correct and random.random() < self.p_correct:
+            resp = random.choice(correct)
+        else:
+            resp = random.choice(choices)
+        rt = max(random.gauss(self.rt_mean, self.rt_sd), self.min_rt)
+        return resp, rt
+
+
+class ScriptedResponder(object):
+    """
+    Give a fixed list of responses to simulated KeyPress and
+    MousePress states, in the order the states ask for them.
+
+    Parameters
+    ----------
+    responses : list
+        List of (response, rt) tuples. A response of None means do not
+        respond to that state.
+    fallback : responder
+        Responder to use once the script runs out. Defaults to a
+        RandomResponder, so the experiment can still finish.
+
+    Example
+    -------
+    exp.responder = ScriptedResponder([('J', .5), ('K', .7), (None, 0)])
+    """
+    def __init__(self, responses, fallback=None):
+        self.responses = list(responses)
+        self._next = 0
+        if fallback is None:
+            fallback = RandomResponder()
+        self.fallback = fallback
+
+    @classmethod
+    def from_file(cls, filename, fallback=None):
+        """
+        Read the responses from a text file with a response and a
+        response time (in seconds) on each line, e.g., "J 0.53". A
+        response of "-" means do not respond.
+        """
+        responses = []
+        with open(filename, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                resp, rt = line.split()
+                if resp == '-':
+                    resp = None
+                responses.append((resp, float(rt)))
+        return cls(responses, fallback=fallback)
+
+    def respond(self, state, choices, correct):
+        if self._next >= len(self.responses):
+            return self.fallback.respond(state, choices, correct)
+        resp, rt = self.responses[self._next]
+        self._next += 1
+        if resp is None:
+            return None
+        return resp, rt
+    respond.__doc__ = RandomResponder.respond.__doc__
+
+
+class SimWindow(object):
+    """
+    Stand-in for the experiment window when simulating. Nothing is
+    drawn or flipped, and the key and mouse presses come from a
+    responder instead of a person.
+
+    Each time a KeyPress or MousePress starts waiting, the responder
+    picks a response and a response time (relative to the state's base
+    time). The press is dispatched at that time if the state is still
+    waiting.
+
+    Parameters
+    ----------
+    exp : Experiment
+        The experiment being simulated.
+    responder : responder
+        Object with a respond(state, choices, correct) method, such as
+        a RandomResponder or ScriptedResponder.
+    width, height : int
+        Size of the pretend window.
+    """
+    def __init__(self, exp, responder, width=800, height=600):
+        self.exp = exp
+        self.responder = responder
+        self.width = width
+        self.height = height
+        self.has_exit = False
+
+        # set empty list of key and mouse handler callbacks
+        self.key_callbacks = []
+        self.mouse_callbacks = []
+
+        # nothing to draw into
+        self.batch = None
+        self.pool = ShownPool(None)
+        self.need_flip = False
+        self.need_draw = False
+
+        # planned presses for each waiting callback
+        self._pending = {}
+
+    def on_draw(self, force=False):
+        if force or self.need_draw:
+            self.need_flip = True
+
+    def flip(self):
+        pass
+
+    def set_clear_color(self, color=(0,0,0,1)):
+        pass
+
+    def set_mouse_visible(self, visible=True):
+        pass
+
+    def close(self):
+        pass
+
+    def on_key_press(self, symbol, modifiers):
+        # call the registered callbacks
+        for c in self.key_callbacks[:]:
+            c(symbol, modifiers, self.exp.event_time)
+
+    def on_mouse_press(self, x, y, button, modifiers):
+        for c in self.mouse_callbacks[:]:
+            c(x, y, button, modifiers, self.exp.event_time)
+
+    def _plan(self, state, is_key):
+        # get a response from the responder, None if it won't respond
+        if is_key:
+            choices, names, default = state.keys, key, 'SPACE'
+        else:
+            choices, names, default = state.buttons, mouse, 'LEFT'
+        choices = [c for c in val(choices) if not c is None]
+        if not choices:
+            choices = [default]
+        correct = [c for c in val(state.correct_resp) if not c is None]
+        res = self.responder.respond(state, choices, correct)
+        if res is None:
+            return None
+        resp, rt = res
+        try:
+            symbol = getattr(names, resp)
+        except AttributeError:
+            raise ValueError('Unknown simulated %s response "%s".' %
+                             ('key' if is_key else 'mouse', resp))
+
+        # time it from the same base as the state's rt
+        base_time = val(state.base_time_src)
+        if base_time is None:
+            base_time = state.state_time
+        press_time = max(base_time+rt, now())
+        wake_at(press_time)
+        return press_time, symbol
+
+    def _dispatch(self, callbacks, is_key):
+        pending = self._pending
+        for c in callbacks[:]:
+            state = c.im_self
+            planned = pending.get(c)
+            if planned is None or planned[0] != state.start_time:
+                # new wait, so ask the responder
+                planned = (state.start_time, self._plan(state, is_key))
+                pending[c] = planned
+            plan = planned[1]
+            if not plan is None and now() >= plan[0]:
+                # time to press it (only once)
+                pending[c] = (state.start_time, None)
+                if is_key:
+                    self.on_key_press(plan[1], 0)
+                else:
+                    self.on_mouse_press(self.width//2, self.height//2,
+                                        plan[1], 0)
+
+    def dispatch_events(self):
+        # forget the plans for states that are done waiting
+        waiting = self.key_callbacks + self.mouse_callbacks
+        for c in self._pending.keys():
+            if not c in waiting:
+                del self._pending[c]
+
+        # press the keys and buttons that are due
+        self._dispatch(self.key_callbacks, True)
+        self._dispatch(self.mouse_callbacks, False)
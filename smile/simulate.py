@@ -0,0 +1,235 @@
+#emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See the COPYING file distributed along with the smile package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+
+"""
+Run an experiment for many simulated subjects in parallel.
+
+Usage:
+
+    python -m smile.simulate script.py [-n NUM_SUBJECTS] [-j PROCESSES]
+        [--prefix PREFIX] [--seed SEED] [-r RESPONSES] [-l {exp,state}]
+        [-o OUT_FILE] [-f] [-- SCRIPT_ARGS...]
+
+Each subject runs the script headless on a virtual clock (see the
+--simulate flag of Experiment) in its own process, with its own
+subject directory under data/ and its own random seed, so shuffles,
+jitter, and random responses differ between subjects but can be
+repeated. When they are done, the logs of all the subjects are merged
+into one csv with subject and seed columns.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import runpy
+import argparse
+from multiprocessing import Pool
+
+import pyglet
+
+from log import merge2csv, BINARY_EXT
+
+def _run_subject(job):
+    # worker for the pool, must be picklable
+    script, subj, seed, responses, script_args = job
+    subj_dir = os.path.join('data', subj)
+    if not os.path.exists(subj_dir):
+        os.makedirs(subj_dir)
+
+    # run it like it was run from the command line
+    sys.argv = [script, '-s', subj, '--simulate', '--seed', str(seed)]
+    if responses:
+        sys.argv += ['-r', responses]
+    sys.argv += script_args
+    script_dir = os.path.dirname(os.path.abspath(script))
+    if not script_dir in sys.path:
+        sys.path.insert(0, script_dir)
+
+    # seed it for anything random done before the Experiment is made
+    random.seed(seed)
+
+    # there may be no display, so pyglet must not make its hidden
+    # shadow window, even if the script loads pyglet before smile
+    pyglet.options['shadow_window'] = False
+
+    # keep the output of each subject separate
+    out = open(os.path.join(subj_dir, 'simulate.out'), 'w')
+    sys.stdout = sys.stderr = out
+    start = time.time()
+    error = None
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit, e:
+        if e.code:
+            error = 'exited with %s' % e.code
+    except Exception, e:
+        import traceback
+        traceback.print_exc()
+        error = ' '.join(str(e).split()) or e.__class__.__name__
+    finally:
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        out.close()
+    return subj, seed, time.time()-start, error
+
+def simulate(script, num_subjects=10, processes=None, prefix='sim',
+             seed=0, responses=None, log='exp', out_file=None,
+             script_args=None, force=False, verbose=True):
+    """
+    Run an experiment script for a number of simulated subjects with
+    a process pool and merge their logs.
+
+    Parameters
+    ----------
+    script : str
+        Experiment script to run.
+    num_subjects : int
+        Number of subjects to simulate.
+    processes : int
+        Number of worker processes, defaults to the number of cores.
+    prefix : str
+        Subjects are named prefix000, prefix001, etc.
+    seed : int
+        Random seed of the first subject, each one after gets the
+        next seed.
+    responses : str
+        File of scripted responses for every subject (see
+        sim.ScriptedResponder), otherwise the responses are random.
+    log : {'exp', 'state'}
+        Which logs to merge.
+    out_file : str
+        Where to write the merged csv, defaults to
+        data/<prefix>_<log>.csv.
+    script_args : list
+        Extra command line args for the script.
+    force : bool
+        Remove the logs of earlier runs of these subjects instead of
+        refusing to run (the logs are appended to otherwise).
+    verbose : bool
+        Print progress.
+
+    Returns a list of (subject, seed, seconds, error) tuples, one for
+    each subject.
+    """
+    if script_args is None:
+        script_args = []
+    subjects = ['%s%03d' % (prefix, i) for i in range(num_subjects)]
+
+    # don't append to the logs of an earlier run
+    existing = [s for s in subjects
+                if os.path.exists(os.path.join('data', s))]
+    if existing:
+        if not force:
+            raise ValueError('Subject directories already exist for %s '
+                             '(use force to remove them).' %
+                             ', '.join(existing))
+        for s in existing:
+            shutil.rmtree(os.path.join('data', s))
+
+    # a fresh process for each subject, so nothing carries over
+    jobs = [(script, subj, seed+i, responses, script_args)
+            for i, subj in enumerate(subjects)]
+    start = time.time()
+    results = []
+    pool = Pool(processes, maxtasksperchild=1)
+    try:
+        for res in pool.imap_unordered(_run_subject, jobs):
+            results.append(res)
+            if verbose:
+                if res[3] is None:
+                    print "%s (seed %d): %.2f s" % res[:3]
+                else:
+                    print "%s (seed %d): FAILED (%s)" % (res[0], res[1],
+                                                         res[3])
+    finally:
+        pool.close()
+        pool.join()
+    results.sort()
+
+    # merge the logs of the subjects that finished
+    log_files = []
+    for subj, subj_seed, duration, error in results:
+        if not error is None:
+            continue
+        for ext in ('.yaml', BINARY_EXT):
+            log_file = os.path.join('data', subj, log+ext)
+            if os.path.exists(log_file):
+                log_files.append((log_file, {'subject':subj,
+                                             'seed':subj_seed}))
+    if out_file is None:
+        out_file = os.path.join('data', '%s_%s.csv' % (prefix, log))
+    if log_files:
+        nrows = merge2csv(log_files, out_file)
+
+    if verbose:
+        nfailed = len([r for r in results if not r[3] is None])
+        print "Simulated %d subjects (%d failed) in %.2f s." % \
+            (len(results), nfailed, time.time()-start)
+        if log_files:
+            print "Merged %d rows into %s" % (nrows, out_file)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate subjects running a SMILE experiment.')
+    parser.add_argument("script",
+                        help="experiment script to run")
+    parser.add_argument("-n", "--num_subjects",
+                        help="number of subjects to simulate",
+                        type=int,
+                        default=10)
+    parser.add_argument("-j", "--processes",
+                        help="number of worker processes",
+                        type=int,
+                        default=None)
+    parser.add_argument("--prefix",
+                        help="prefix for the subject ids",
+                        default='sim')
+    parser.add_argument("--seed",
+                        help="random seed of the first subject",
+                        type=int,
+                        default=0)
+    parser.add_argument("-r", "--responses",
+                        help="file of scripted responses",
+                        default=None)
+    parser.add_argument("-l", "--log",
+                        help="which logs to merge",
+                        choices=['exp', 'state'],
+                        default='exp')
+    parser.add_argument("-o", "--out_file",
+                        help="where to write the merged csv",
+                        default=None)
+    parser.add_argument("-f", "--force",
+                        help="remove the logs of earlier runs of these subjects",
+                        action='store_true')
+    # anything after -- is for the script
+    if argv is None:
+        argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        ind = argv.index('--')
+        argv, script_args = argv[:ind], argv[ind+1:]
+    args = parser.parse_args(argv)
+
+    try:
+        results = simulate(args.script, num_subjects=args.num_subjects,
+                           processes=args.processes, prefix=args.prefix,
+                           seed=args.seed, responses=args.responses,
+                           log=args.log, out_file=args.out_file,
+                           script_args=script_args, force=args.force)
+    except ValueError, e:
+        parser.error(str(e))
+    if [r for r in results if not r[3] is None]:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,110 +7,27 @@
 #
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
-from pyglet import clock
-now = clock._default.time
 import random
+from operator import attrgetter
 
-from ref import Ref, val
+from ref import Ref, val, invalidate, dependencies, snapshot
 from utils import rindex, get_class_name
-from log import dump
+import scheduler
+from scheduler import schedule_delayed_interval, schedule_delayed, unschedule
+from scheduler import wake_at, schedule_once
 
-# custom schedule functions (add delays)
-def _schedule_interval_callback(dt, func, interval, *args, **kwargs):
+def now():
     """
-    Schedule a callback with specified interval.
-    
-    Parameters
-    ----------
-    dt : float
-        The number of seconds since the last function call.
-    func : function
-        The function to call when the timer lapses.
-    interval : float
-    	The number of seconds to wait between each call
-    
-    Example
-    -------
-    
-    _schedule_interval_callback(dt, function, 1.0)
-    	The function will be called one second after it
-    	was last called.
-
-    """
-    # schedule it
-    if interval > 0:
-        clock.schedule_interval(func, interval, *args, **kwargs)
-    # call it
-    func(dt, *args, **kwargs)
-
-def schedule_delayed_interval(func, delay, interval, *args, **kwargs):
-    """
-    Schedule a callback with specified interval to begin after the
-    specified delay.
-    
-    Parameters
-    ----------
-    func : function
-        The function to call when the timer lapses.
-    delay : float
-    	The number of seconds after the interval before the function
-    	begins.
-    interval : float
-    	The number of seconds to wait between each call
-    
-    Example
-    -------
-    schedule_delayed_interval(function, 2.0, 1.0)
-    	The function will be called every second starting after 
-        2 seconds
-
-    """
-    clock.schedule_once(_schedule_interval_callback, delay, func, interval, *args, **kwargs)
-    
-def _schedule_callback(dt, func, *args, **kwargs):
-    """
-    Schedule a callback to occur every event loop with no delay or interval
-    
-    Parameters
-    ----------
-    dt: float
-        The number of seconds since the last function call.
-    func:function
-        The function to call when the timer lapses.
-
-    Example
-    -------    
-    _schedule_callback(dt, function)
-    	The function will be called immediately after the previous
-    	event loop
-    	
+    Get the current time from the scheduler's clock.
     """
-    # schedule it
-    clock.schedule(func, *args, **kwargs)
-    # call it
-    func(dt, *args, **kwargs)
+    # a function rather than the clock's bound method, so Refs to it
+    # can be pickled
+    return scheduler._default.time()
 
-def schedule_delayed(func, delay, *args, **kwargs):
-    """
-    Schedule a callback to occur every event loop after the specified
-    initial delay.
-    
-    Parameters
-    ----------
-    func:function
-        The function to call when the timer lapses.
-    delay: float
-    	The number of seconds after the interval before the function
-    	begins.
-    	
-    Example
-    -------    
-    schedule_delay(function, 3.0)
-    	The function will be called on every loop starting 
-        after 3.0 seconds.    	
-    """
-    clock.schedule_once(_schedule_callback, delay, func, *args, **kwargs)
 
+# log values of these types never need to be evaluated
+_plain_log_types = frozenset([int, long, float, bool, str, unicode, 
+                              type(None)])
 
 class RunOnEnter():
     """Inherited class to indicate to a state that it should run
@@ -186,14 +103,67 @@ class State(object):
                           'last_call_time','last_call_error',
                           'duration']
 
+    def __getstate__(self):
+        # the log schema holds functions that can't be pickled, so it
+        # gets rebuilt when needed
+        state = self.__dict__.copy()
+        state.pop('_log_schema', None)
+        state.pop('_log_schema_attrs', None)
+        return state
+
+    # log schemas shared by all instances of a class with the same
+    # log attrs
+    _log_schemas = {}
+    _log_schema = None
+    _log_schema_attrs = None
+
+    def get_log_schema(self):
+        """
+        Get the log schema, a tuple of the field names and a function
+        that gets those fields from a state as a tuple.
+
+        The schema is only built once for each State subclass and list
+        of log attributes.
+        """
+        if self._log_schema_attrs != self.log_attrs:
+            # (re)build it
+            fields = tuple(self.log_attrs)
+            key = (self.__class__, fields)
+            schema = State._log_schemas.get(key)
+            if schema is None:
+                getter = attrgetter(*fields)
+                if len(fields) == 1:
+                    # attrgetter returns a value, not a tuple, for one
+                    getter = lambda obj, g=getter: (g(obj),)
+                schema = (fields, getter)
+                State._log_schemas[key] = schema
+            self._log_schema = schema
+            self._log_schema_attrs = list(self.log_attrs)
+        return self._log_schema
+
+    def get_log_row(self):
+        """
+        Evaluate all the log attributes and generate a tuple in the
+        order of the fields of the log schema.
+        """
+        fields, getter = self.get_log_schema()
+        try:
+            row = getter(self)
+        except AttributeError:
+            # some attrs are missing, so fill them in with None
+            row = [getattr(self, a, None) for a in fields]
+
+        # only evaluate the values that might hold Refs, and copy any
+        # containers, since the row is written later
+        return tuple([v if type(v) in _plain_log_types else snapshot(val(v))
+                      for v in row])
+
     def get_log(self):
     	"""
         Evaluate all the log attributes and generate a dict.
         """
         
-        keyvals = [(a,val(getattr(self,a))) if hasattr(self,a) 
-                   else (a,None) for a in self.log_attrs]
-        return dict(keyvals)
+        return dict(zip(self.get_log_schema()[0], self.get_log_row()))
 
     def get_log_stream(self):
     	"""
@@ -203,6 +173,42 @@ class State(object):
             return None
         else:
             return self.exp.state_log_stream
+
+    def get_state_log_writer(self):
+        """
+        Gets the background log writer for the current experiment
+        """
+        if self.exp is None:
+            return None
+        else:
+            return self.exp.state_log_writer
+
+    def write_log(self):
+        """
+        Hand a snapshot of the log off to the experiment's log writer.
+        """
+        writer = self.get_state_log_writer()
+        if not writer is None:
+            writer.write_row(self.get_log_schema()[0], self.get_log_row(),
+                             self.get_loop_index())
+
+    _loops = None
+
+    def get_loop_index(self):
+        """
+        Get a tuple of the current iteration of each enclosing Loop,
+        outermost first.
+        """
+        if self._loops is None:
+            # find the enclosing loops once
+            loops = []
+            parent = self.parent
+            while not parent is None:
+                if isinstance(parent, Loop):
+                    loops.insert(0, parent)
+                parent = parent.parent
+            self._loops = loops
+        return tuple([l.i for l in self._loops])
         
     def __getitem__(self, index):
     	"""
@@ -215,6 +221,30 @@ class State(object):
             raise ValueError('%s state does not have attribute "%s".' % 
                              (class_name, index))
 
+    def get_dependencies(self):
+        """
+        Get the objects and attributes read by the Refs this state
+        holds, as a dict mapping each of its attributes that holds
+        Refs to a list of (obj, attr) pairs (see ref.dependencies).
+
+        Example
+        -------
+        kp = KeyPress()
+        with If(kp['correct']) as if_state:
+            ...
+        # find the states that feed the conditional
+        print if_state.get_dependencies()['cond']
+        """
+        deps = {}
+        for name, value in self.__dict__.iteritems():
+            if name in ('parent', 'children', 'exp'):
+                # not Refs, and can be huge
+                continue
+            found = dependencies(value)
+            if found:
+                deps[name] = found
+        return deps
+
     # PBS: Must eventually check for specific attrs for this to work
     #def __getattribute__(self, name):
     #    return Ref(self, name)
@@ -227,7 +257,6 @@ class State(object):
     	"""
     	Run at the scheduled state time.
     	"""
-
         self.last_call_time = now()
         self.last_call_error = self.last_call_time - self.state_time
         if self.first_call_time is None:
@@ -245,6 +274,9 @@ class State(object):
             # we're done
             self.leave()
 
+        # drop the cached values of Refs that read our attributes
+        invalidate(self)
+
     def get_parent_state_time(self):
     	"""
     	Returns state time for the parent. If no parent, logs current time. 
@@ -258,6 +290,17 @@ class State(object):
         if self.parent:
             self.parent.advance_state_time(duration)
 
+    def prepare(self):
+        """
+        Get ready ahead of time to be entered (e.g., load a stimulus).
+        Most states have nothing to do.
+        """
+        pass
+
+    def prepare_callback(self, dt):
+        # so it can be scheduled
+        self.prepare()
+
     def _enter(self):
         pass
 
@@ -265,7 +308,6 @@ class State(object):
         """
         Gets the starting time from the parent state
         """
-        
         self.state_time = self.get_parent_state_time()
         self.start_time = self.state_time
 
@@ -297,7 +339,8 @@ class State(object):
         if self.duration > 0:
             self.advance_parent_state_time(self.duration)
 
-        pass
+        # drop the cached values of Refs that read our attributes
+        invalidate(self)
 
     def _leave(self):
         pass
@@ -306,7 +349,6 @@ class State(object):
         """
         Gets the end time of the state (logs current time)
         """
-        
         self.end_time = now()
         
         # update the parent state time to actual elapsed time if necessary
@@ -320,21 +362,27 @@ class State(object):
             self.advance_parent_state_time(duration)
 
         # remove the callback from the schedule
-        clock.unschedule(self.callback)
+        unschedule(self.callback)
 
         # notify the parent that we're done
         self.active = False
+        was_done = self.done
         self.done = True
         if self.parent:
             self.parent.check = True
+            if not was_done:
+                self.parent._child_left(self)
 
         # call custom leave code
         self._leave()
 
+        # drop the cached values of Refs that read our attributes
+        invalidate(self)
+
         # write log to the state log
         #print self.get_log()
         if self.save_log:
-            dump([self.get_log()],self.get_log_stream())
+            self.write_log()
         pass
     
 
@@ -374,6 +422,10 @@ class ParentState(State, RunOnEnter):
         
         self.check = False
 
+        # number of children done and index of the next one to enter
+        self._num_done = 0
+        self._cursor = 0
+
     def get_state_time(self):
         return self.state_time
 
@@ -391,9 +443,32 @@ class ParentState(State, RunOnEnter):
         # set all children to not done
         for c in self.children:
             c.done = False
+        self._num_done = 0
+        self._cursor = 0
         self.check = True
         self._advanced = 0 # for Parallel children
 
+    def _child_left(self, child):
+        # called once each time a child is done
+        self._num_done += 1
+
+    def prepare(self):
+        # the first child is the one that will be entered first
+        if self.children:
+            self.children[0].prepare()
+
+    def _leave_children(self):
+        # leave the children that are still running
+        for c in self.children:
+            if c.active:
+                c.leave()
+
+    def leave(self):
+        if self._num_done < len(self.children):
+            # ending early, so stop the children that are still running
+            self._leave_children()
+        super(ParentState, self).leave()
+
     def __enter__(self):
         # push self as current parent
         if not self.exp is None:
@@ -412,24 +487,87 @@ class Parallel(ParentState):
     Parent state that runs its children in parallel.
 
     A Parallel Parent State is done when all its children have
-    finished.
+    finished, or as soon as any one of them has finished if any_done
+    is True.
+
+    Parameters
+    ----------
+    children: list
+        Children States (objects) to run in parallel
+    parent: object
+        Parent state object
+    duration: float
+        Duration of the parent state. Defaults to -1
+    save_log: bool
+        If set to 'True,' details about the parent state will be
+        automatically saved in the log files.
+    any_done: bool
+        Leave as soon as the first child is done, leaving any
+        children that are still active. Defaults to False
+
+    Example
+    -------
+    with Parallel(any_done=True):
+        Show(Text('Respond now!'), duration=5.0)
+        KeyPress(keys=['J','K'])
+
+    The text stays up until a key is pressed or five seconds have
+    passed, whichever comes first (a Show that is left early takes
+    its stimulus down).
     
     """        
+    def __init__(self, children=None, parent=None, duration=-1, 
+                 save_log=True, any_done=False):
+        super(Parallel, self).__init__(children=children, parent=parent, 
+                                       duration=duration, 
+                                       save_log=save_log)
+        self.any_done = any_done
+
+        # children still to enter and those running
+        self._pending = []
+        self._active = set()
+
+    def _enter(self):
+        super(Parallel, self)._enter()
+        self._pending = self.children[:]
+        self._active = set()
+
+    def _child_left(self, child):
+        super(Parallel, self)._child_left(child)
+        self._active.discard(child)
+
+    def prepare(self):
+        # they all start together
+        for c in self.children:
+            c.prepare()
+
+    def _leave_children(self):
+        # leave the ones still running (they remove themselves)
+        for c in list(self._active):
+            c.leave()
+        self._pending = []
+
     def _callback(self, dt):
         if self.check:
             self.check = False
-            # process the children
-            # start those that are not active and not done
-            num_done = 0
-            for c in self.children:
-                if c.done:
-                    num_done += 1
-                    continue
-                if not c.active:
-                    c.enter()
-            if num_done == len(self.children):
-                # we're done
-                #self.interval = 0
+            # start the children that have not been entered
+            if self._pending:
+                pending = self._pending
+                self._pending = []
+                for c in pending:
+                    if not c.done and not c.active:
+                        self._active.add(c)
+                        c.enter()
+
+            if self._num_done == len(self.children) or \
+                    (self._num_done > 0 and val(self.any_done)):
+                if self._num_done < len(self.children):
+                    # ending early, so only advance the time that passed
+                    # instead of the longest child duration
+                    advanced = max(now() - self.state_time, 0)
+                    self._leave_children()
+                    self._advanced = advanced
+
                 # advance the state_time
                 self.state_time += self._advanced
                 self.leave()
@@ -450,28 +588,34 @@ class Serial(ParentState):
     finished.
     
     """
+    def _enter_next(self):
+        # start the next child that has not been entered, if any
+        i = self._cursor
+        if i >= len(self.children):
+            return
+        if i > 0 and \
+                not self.children[i-1].done and \
+                self.children[i-1].duration < 0:
+            # we have to wait until it's done
+            return
+
+        # start the next one
+        self._cursor += 1
+        self.children[i].enter()
+
+        # if it will take a while, get the one after it ready meanwhile
+        if self._cursor < len(self.children) and \
+                self.children[i].duration != 0:
+            schedule_once(self.children[self._cursor].prepare_callback, 0)
+
     def _callback(self, dt):
         if self.check:
             self.check = False
             # process the children
-            # start those that are not active and not done
-            num_done = 0
-            for i,c in enumerate(self.children):
-                if c.done:
-                    num_done += 1
-                    continue
-                if not c.active:
-                    if i > 0 and \
-                            not self.children[i-1].done and \
-                            self.children[i-1].duration < 0:
-                        # we have to wait until it's done
-                        break
-
-                    # start the next one
-                    c.enter()
-                    break
-
-            if num_done == len(self.children):
+            # start the next one that is not active and not done
+            if self._num_done < len(self.children):
+                self._enter_next()
+            else:
                 # we're done
                 #self.interval = 0
                 self.leave()
@@ -565,6 +709,10 @@ class If(ParentState):
         # must evaluate each cond
         self.outcome = [not v is False for v in val(self.cond)]
         super(If, self)._enter()
+
+    def prepare(self):
+        # can't tell which branch until the conditions are evaluated
+        pass
         
     def _callback(self, dt):
         if self.check:
@@ -750,24 +898,10 @@ class Loop(Serial):
                 return
                 
             # process the children            
-            # start those that are not active and not done
-            num_done = 0
-            for i,c in enumerate(self.children):
-                if c.done:
-                    num_done += 1
-                    continue
-                if not c.active:
-                    if i > 0 and \
-                            not self.children[i-1].done and \
-                            self.children[i-1].duration < 0:
-                        # we have to wait until it's done
-                        break
-
-                    # start the next one
-                    c.enter()
-                    break
-
-            if num_done == len(self.children):
+            # start the next one that is not active and not done
+            if self._num_done < len(self.children):
+                self._enter_next()
+            else:
                 # we're done with this sequence
                 finished = False
                 if not self.iterable is None:
@@ -781,13 +915,14 @@ class Loop(Serial):
                         self._shuffled = False
                     else:
                         # dump log
-                        dump([self.get_log()],self.get_log_stream())
+                        self.write_log()
 
                         # set to next
                         self.i += 1
                 else:
                     # conditional looping so just set to next
                     self.i += 1
+                invalidate()
                         
                 # update everything for the next loop
                 if not finished:
@@ -844,6 +979,10 @@ class Wait(State):
         self.duration = random.uniform(val(self.wait_duration),
                                        val(self.wait_duration)+val(self.jitter))
 
+        if self.stay_active:
+            # make sure there's a tick when we're done waiting
+            wake_at(self.state_time+self.duration)
+
     def _callback(self, dt):
         if not self.stay_active or now() >= self.state_time+self.duration:
             # we're done
@@ -879,7 +1018,7 @@ class ResetClock(State, RunOnEnter):
                                          save_log=save_log)
         if new_time is None:
             # eval to now if nothing specified
-            new_time = Ref(gfunc=lambda:now())
+            new_time = Ref(gfunc=now)
         self.new_time = new_time
 
     def _callback(self, dt):
@@ -932,10 +1071,14 @@ class Func(State):
             self.kwargs = {}
 
     def _callback(self, dt):
-        # process the refs
-        args = val(self.args)
-        kwargs = val(self.kwargs)
+        # process the refs (copying the containers, so the func can't
+        # change the args for the next time it's called)
+        args = snapshot(val(self.args))
+        kwargs = snapshot(val(self.kwargs))
         self.res = self.func(self, *args, **kwargs)
+
+        # the function could have changed anything
+        invalidate()
     
 
 class Debug(State):
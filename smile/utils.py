@@ -13,6 +13,10 @@ import struct
 import random
 from itertools import *
 from StringIO import StringIO
+import sys
+import os
+
+import pyglet
 
 def rindex(lst, item):
     try:
@@ -26,6 +30,39 @@ def get_class_name(obj):
     uname = name + "_" + mem_id
     return name,uname
 
+def simulating(argv=None):
+    """
+    Whether the command line (sys.argv by default) asks to run a
+    simulation (see the --simulate and --responses flags of
+    Experiment), so there may be no display.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    for arg in argv:
+        if arg == '--':
+            break
+        arg = arg.split('=', 1)[0]
+        if arg == '-sim' or (arg.startswith('-r') and arg[:2] != '--'):
+            return True
+        if len(arg) > 2 and arg.startswith('--') and \
+           ('--simulate'.startswith(arg) or '--responses'.startswith(arg)):
+            # argparse takes any unique prefix
+            return True
+    return False
+
+def setup_pyglet():
+    """
+    Set pyglet's options. This must be done before pyglet's window
+    or gl modules are loaded, since loading them makes a hidden
+    shadow window, which needs a display that a simulation (see
+    `simulating`) may not have. It is also skipped when there is no X
+    display at all (e.g., when importing smile.simulate on a cluster).
+    """
+    no_display = sys.platform.startswith('linux') and \
+        not os.environ.get('DISPLAY')
+    if no_display or simulating():
+        pyglet.options['shadow_window'] = False
+
 
 #
 # some audio utils adapted from:
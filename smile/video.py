@@ -8,19 +8,28 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 
 from state import State, Wait, Serial
-from state import schedule_delayed_interval, schedule_delayed
-from ref import Ref, val
+from state import schedule_delayed_interval, schedule_delayed, unschedule
+from state import schedule_once
+from ref import Ref, val, invalidate, is_pure
 
 # get the last instance of the experiment class
 from experiment import Experiment, now
 
-from pyglet import clock
 import pyglet
 
 import random
 import math
 
 
+class _SimShown(object):
+    # stands in for a label, sprite, or vertex list when simulating
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def delete(self):
+        pass
+
+
 class VisualState(State):
     """
     State that handles drawing and showing of a visual
@@ -96,19 +105,82 @@ class VisualState(State):
         self.first_flip = 0
         self.first_draw = 0
 
+        # (fixed values, shown) made ahead of time by prepare
+        self._prepared = None
+        self._preparable = None
+
         # set the log attrs
         self.log_attrs.extend(['last_draw', 'last_update', 'last_flip'])
+
+    # whether the update makes its own shown (as opposed to changing
+    # or removing another state's)
+    _makes_shown = True
                                
     def _update_callback(self, dt):
         # children must implement drawing the showable to make it shown
         pass
 
+    def prepare(self):
+        """
+        Get the stimulus ready to show ahead of time (e.g., load the
+        image or lay out the text), so the update only has to show
+        it. This is done when a Serial is about to reach the state or
+        while the state waits to be shown.
+
+        The update evaluates the Refs again, so a state is only
+        prepared if its Refs are pure (see ref.pure). A Ref that pops
+        from a list or picks something at random is left to run once,
+        at the update.
+        """
+        if not self._prepared is None or self.exp is None or \
+                self.exp.window is None or self.exp.simulate or \
+                not self._makes_shown:
+            return
+        if self._preparable is None:
+            self._preparable = all([is_pure(v) 
+                                    for v in self.__dict__.itervalues()])
+        if not self._preparable:
+            return
+        try:
+            self._prepared = self._prepare()
+        except Exception:
+            # it may need something that isn't there until the update
+            # (e.g., a file named by a key that hasn't been pressed or
+            # a variable that hasn't been set), so leave it for then
+            self._prepared = None
+
+    def _prepare(self):
+        # children can make their shown ahead of time (hidden) and
+        # return (fixed, shown), where fixed are the values the shown
+        # can't be changed to match
+        return None
+
+    def _take_prepared(self, fixed):
+        # get the prepared shown if it was made with the same fixed
+        # values, otherwise give it back
+        if self._prepared is None:
+            return None
+        prep_fixed, shown = self._prepared
+        self._prepared = None
+        if prep_fixed != fixed:
+            self.exp.window.pool.release(shown)
+            return None
+        return shown
+
+    def _sim_shown(self):
+        # nothing can be drawn when simulating, so stand in for it
+        return _SimShown()
+
     def update_callback(self, dt):
         # call the user-defined show
-        self.shown = self._update_callback(dt)
+        if self.exp.simulate and self._makes_shown:
+            self.shown = self._sim_shown()
+        else:
+            self.shown = self._update_callback(dt)
         self.last_update = now()
         if self.first_update == 0:
             self.first_update = self.last_update
+        invalidate(self)
 
         # tell the exp window we need a draw
         self.exp.window.need_draw = True
@@ -119,6 +191,7 @@ class VisualState(State):
         self.last_draw = now()
         if self.first_draw == 0:
             self.first_draw = self.last_draw
+        invalidate(self)
 
     def _callback(self, dt):
         # call the flip, recording the time
@@ -173,10 +246,20 @@ class VisualState(State):
             update_delay = 0
         self.schedule_update(update_delay)
 
+        # if there's time before the update, get ready on the next tick
+        if update_delay > self.exp.flip_interval*2:
+            schedule_once(self.prepare_callback, 0)
+
     def _leave(self):
         # unschedule the various callbacks
-        clock.unschedule(self.update_callback)
-        clock.unschedule(self.draw_callback)
+        unschedule(self.update_callback)
+        unschedule(self.draw_callback)
+        unschedule(self.prepare_callback)
+
+        # give back anything prepared that wasn't shown
+        if not self._prepared is None:
+            self.exp.window.pool.release(self._prepared[1])
+            self._prepared = None
 
 
 class Unshow(VisualState):
@@ -218,14 +301,16 @@ class Unshow(VisualState):
         # we haven't shown anything yet
         self.vstate = vstate
 
+    _makes_shown = False
+
     def _update_callback(self, dt):
         # children must implement drawing the showable to make it shown
         # grab the vstate and associated shown
         vstate = val(self.vstate)
         shown = val(vstate.shown)
-        # if something is shown, then delete it
+        # if something is shown, then hand it back to be reused
         if shown:
-            shown.delete()
+            self.exp.window.pool.release(shown)
         return shown
 
 
@@ -305,6 +390,41 @@ class Show(Serial):
         # append times to log
         self.log_attrs.extend(['show_time','unshow_time'])
 
+    def _enter(self):
+        # an Unshow still taking down the last stimulus (see
+        # _leave_children) has to be done before we start over
+        if self._unshow_state.active:
+            self._unshow_state.leave()
+        super(Show, self)._enter()
+
+    def _leave_children(self):
+        # if we're cut short (e.g., by a Parallel with any_done) while
+        # the stimulus is up, leave the Unshow running to take it down
+        # on the next flip instead of leaving it on the screen
+        vstate = self._show_state
+        unshow = self._unshow_state
+        keep = None
+        if (vstate.active or vstate.done) and vstate.last_update and \
+                not unshow.done:
+            if not unshow.active:
+                # we didn't get to it yet
+                unshow.enter()
+            elif unshow.last_update == 0:
+                # it's waiting on our duration, so start it over from now
+                unschedule(unshow.callback)
+                unschedule(unshow.update_callback)
+                unschedule(unshow.draw_callback)
+                unshow.state_time = now()
+                unshow.start_time = unshow.state_time
+                schedule_delayed_interval(unshow.callback, 0, 0)
+                unshow.schedule_update(0)
+            keep = unshow
+
+        # leave the rest of the children that are still running
+        for c in self.children:
+            if c.active and not c is keep:
+                c.leave()
+
 
 class Update(VisualState):
     """
@@ -361,12 +481,18 @@ class Update(VisualState):
         # update more log attrs
         self.log_attrs.extend(['attr', 'value'])
 
+    _makes_shown = False
+
     def _update_callback(self, dt):
-        self.shown = val(self.vstate).shown
+        vstate = val(self.vstate)
+        self.shown = vstate.shown
         setattr(self.shown,
                 val(self.attr),
                 val(self.value))
 
+        # Refs reading the shown item go through its state
+        invalidate(vstate)
+
 
 class BackColor(VisualState):
     """
@@ -406,6 +532,8 @@ class BackColor(VisualState):
         self.color = color
         self.log_attrs.extend(['color'])
 
+    _makes_shown = False
+
     def _update_callback(self, dt):
         self.exp.window.set_clear_color(val(self.color))
 
@@ -524,10 +652,10 @@ class Rectangle(VisualState):
         x2 = x1+width
         y2 = y1+height
         color = list(val(self.color))
-        self.shown = self.exp.window.batch.add(4, pyglet.gl.GL_QUADS, 
-                                               val(self.group),
-                                               ('v2i', [x1, y1, x2, y1, x2, y2, x1, y2]),
-                                               ('c4B', color * 4))
+        self.shown = self.exp.window.pool.vertex_list(4, pyglet.gl.GL_QUADS, 
+                                                      val(self.group),
+                                                      ('v2i', [x1, y1, x2, y1, x2, y2, x1, y2]),
+                                                      ('c4B', color * 4))
 
         return self.shown
 
@@ -544,6 +672,14 @@ class grPointSize (pyglet.graphics.Group):
     def unset_state(self):
         pyglet.gl.glPointSize(1.0)
 
+# one group for each dot size, so the dots can share them
+_point_size_groups = {}
+
+def _get_point_size_group(size):
+    if not size in _point_size_groups:
+        _point_size_groups[size] = grPointSize(size)
+    return _point_size_groups[size]
+
 class DotBox(VisualState):
     """
     Draw a random dots in a box shape.
@@ -689,10 +825,10 @@ class DotBox(VisualState):
         color = list(val(self.color))
         
         # draw the dots
-        self.shown = self.exp.window.batch.add(num_dots, pyglet.gl.GL_POINTS, 
-                                               grPointSize(dot_size),
-                                               ('v2i', points),
-                                               ('c4B', color*num_dots))
+        self.shown = self.exp.window.pool.vertex_list(num_dots, pyglet.gl.GL_POINTS, 
+                                                      _get_point_size_group(dot_size),
+                                                      ('v2i', points),
+                                                      ('c4B', color*num_dots))
         return self.shown
 
 
@@ -824,34 +960,65 @@ class Text(VisualState):
                                'x', 'y', 'anchor_x', 'anchor_y', 'bold',
                                'italic', 'halign', 'width', 'height', 'multiline'])
 
-        pass
+        # the label we showed last, to reuse on the next update
+        self._label = None
+
+    def _label_props(self):
+        return dict(text=val(self.textstr),
+                    font_name=val(self.font_name),
+                    font_size=val(self.font_size),
+                    color=val(self.color),
+                    x=val(self.x), y=val(self.y),
+                    anchor_x=val(self.anchor_x), 
+                    anchor_y=val(self.anchor_y),
+                    bold=val(self.bold),
+                    italic=val(self.italic),
+                    halign=val(self.halign),
+                    width=val(self.width),
+                    height=val(self.height),
+                    multiline=val(self.multiline))
+
+    def _prepare(self):
+        pool = self.exp.window.pool
+        if not self.shown is None and pool.in_use(self.shown, owner=self):
+            # it will be updated in place
+            return None
+        # lay it out off the screen
+        fixed = (val(self.dpi), val(self.group))
+        label = pool.label(dpi=fixed[0], group=fixed[1],
+                           owner=self, reuse=self._label, visible=False,
+                           **self._label_props())
+        self._label = label
+        return fixed, label
 
     def _update_callback(self, dt):
         # children must implement drawing the showable to make it shown
-        if False: #self.shown:
-            # update with the values
-            pass
+        pool = self.exp.window.pool
+        props = self._label_props()
+        fixed = (val(self.dpi), val(self.group))
+        label = self._take_prepared(fixed)
+        if not label is None:
+            # move the prepared label into place (and fix anything
+            # that changed since)
+            pool.patch_label(label, props)
+            self.shown = label
+        elif not self.shown is None and pool.in_use(self.shown, owner=self):
+            # still showing our label, so update it with the values
+            # that changed (a move doesn't need a new layout)
+            pool.patch_label(self.shown, props)
         else:
-            # make the new shown and return it
-            self.shown = pyglet.text.Label(val(self.textstr),
-                                           font_name=val(self.font_name),
-                                           font_size=val(self.font_size),
-                                           color=val(self.color),
-                                           x=val(self.x), y=val(self.y),
-                                           anchor_x=val(self.anchor_x), 
-                                           anchor_y=val(self.anchor_y),
-                                           bold=val(self.bold),
-                                           italic=val(self.italic),
-                                           halign=val(self.halign),
-                                           width=val(self.width),
-                                           height=val(self.height),
-                                           multiline=val(self.multiline),
-                                           dpi=val(self.dpi),
-                                           group=val(self.group),
-                                           batch=self.exp.window.batch)
+            # get our old label back if it's free (or a new one)
+            self.shown = pool.label(dpi=fixed[0], group=fixed[1],
+                                    owner=self, reuse=self._label,
+                                    **props)
+            self._label = self.shown
 
         return self.shown
 
+    def _sim_shown(self):
+        # keep the text, which other states may read (e.g., FreeKey)
+        return _SimShown(text=val(self.textstr))
+
 
 class Image(VisualState):
     """
@@ -954,43 +1121,67 @@ class Image(VisualState):
         self.flip_x = flip_x
         self.flip_y = flip_y
 
+        # (imgstr, flip_x, flip_y) of the loaded image
+        self.img = None
+        self._img_key = None
+
         # append log attrs
         self.log_attrs.extend(['imgstr', 'rotation', 'scale', 'opacity',
                                'x', 'y', 'flip_x', 'flip_y'])
         
         pass
 
+    def _load_image(self):
+        # load the image, unless it's the one we already have
+        img_key = (val(self.imgstr), val(self.flip_x), val(self.flip_y))
+        if img_key != self._img_key:
+            self.img = pyglet.resource.image(img_key[0], 
+                                             flip_x=img_key[1],
+                                             flip_y=img_key[2])
+            self._img_key = img_key
+
+        # process the anchors
+        anchor_x = val(self.anchor_x)
+        if anchor_x is None:
+            # set to center
+            anchor_x = self.img.width//2
+        self.img.anchor_x = anchor_x
+        anchor_y = val(self.anchor_y)
+        if anchor_y is None:
+            # set to center
+            anchor_y = self.img.height//2
+        self.img.anchor_y = anchor_y
+        return self.img
+
+    def _sprite_props(self):
+        return dict(x=val(self.x), y=val(self.y),
+                    scale=val(self.scale),
+                    rotation=val(self.rotation),
+                    opacity=val(self.opacity))
+
+    def _prepare(self):
+        # decode and upload the image to a hidden sprite
+        group = val(self.group)
+        sprite = self.exp.window.pool.sprite(self._load_image(), group=group,
+                                             visible=False,
+                                             **self._sprite_props())
+        return (group,), sprite
+
     def _update_callback(self, dt):
         # children must implement drawing the showable to make it shown
-        if False: #not self.shown is None:
-            # update with the values
-            pass
+        group = val(self.group)
+        img = self._load_image()
+        sprite = self._take_prepared((group,))
+        if not sprite is None:
+            # just show the prepared sprite (fixing anything that
+            # changed since)
+            self.exp.window.pool.patch_sprite(sprite, img,
+                                              **self._sprite_props())
+            self.shown = sprite
         else:
-            # make the new image
-            self.img = pyglet.resource.image(val(self.imgstr), 
-                                             flip_x=val(self.flip_x),
-                                             flip_y=val(self.flip_y))
-
-            # process the anchors
-            anchor_x = val(self.anchor_x)
-            if anchor_x is None:
-                # set to center
-                anchor_x = self.img.width//2
-            self.img.anchor_x = anchor_x
-            anchor_y = val(self.anchor_y)
-            if anchor_y is None:
-                # set to center
-                anchor_y = self.img.height//2
-            self.img.anchor_y = anchor_y
-            
-            # make the sprite from the image
-            self.shown = pyglet.sprite.Sprite(self.img,
-                                              x=val(self.x), y=val(self.y),
-                                              group=val(self.group),
-                                              batch=self.exp.window.batch)
-            self.shown.scale = val(self.scale)
-            self.shown.rotation = val(self.rotation)
-            self.shown.opacity = val(self.opacity)
+            # get a sprite showing the image
+            self.shown = self.exp.window.pool.sprite(img, group=group,
+                                                     **self._sprite_props())
 
         return self.shown
 
@@ -1103,6 +1294,18 @@ class Movie(VisualState):
         
         pass
 
+    def __getstate__(self):
+        # the player can't be pickled, so make a new one when loaded
+        state = super(Movie, self).__getstate__()
+        state.pop('_player', None)
+        state.pop('_source', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._player = pyglet.media.Player()
+        self._player.eos_action = self._player.EOS_PAUSE
+
     def _enter(self):
         # load the media
         self._source = pyglet.media.load(val(self.movstr))